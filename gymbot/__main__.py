@@ -1,11 +1,14 @@
-import hashlib
+import asyncio
+import csv
 import logging
 import os
-from datetime import datetime
+import signal
+import tempfile
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
 
 from telegram import (
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
+    CallbackQuery,
     Update,
 )
 from telegram.constants import ChatAction
@@ -13,10 +16,29 @@ from telegram.ext import (
     CallbackContext,
     CommandHandler,
     ConversationHandler,
+    MessageHandler,
+    TypeHandler,
+    filters,
 )
-from telegram.ext import CallbackQueryHandler, ApplicationBuilder
-
-from gymbot.tools import read_config, read_csv, plot_exercises
+from telegram.ext import Application, CallbackQueryHandler, ApplicationBuilder
+
+from gymbot.apicalls import ApiCallCounter, CountingRequest
+from gymbot.callbacks import Selection, decode_selection, is_sets_choice
+from gymbot.codes import get_exercise_codes
+from gymbot.executor import IOExecutor, LoopMonitor
+from gymbot.exercises import ExerciseRegistry, get_exercise_registry
+from gymbot.export import export_filename, export_formats, export_history, spool_bytes
+from gymbot.importer import format_errors, parse_upload
+from gymbot.index import UserIndex
+from gymbot.keyboards import Keyboards, again_data
+from gymbot.locks import PerUserUpdateProcessor, UserLocks
+from gymbot.paths import get_path_resolver, user_file_suffixes
+from gymbot.persistence import get_persistence
+from gymbot.quicklog import ExerciseMatcher, parse_quick_log
+from gymbot.sessions import get_session_store
+from gymbot.storage import file_version, get_storage
+from gymbot.users import LegacyRenames, get_user_ids
+from gymbot.tools import read_config, plot_exercises
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING
@@ -27,17 +49,59 @@ outdir = "logs"
 
 config = read_config(outdir)
 
-df_columns = ["group", "timestamp", "exercise", "kg", "reps"]
+resolver = get_path_resolver(config, outdir)
+user_index = None
+if config.get("user_index", True):
+    user_index = UserIndex(
+        os.path.join(outdir, config.get("user_index_file", "users.sqlite"))
+    )
+storage = get_storage(config, outdir, resolver, user_index)
+
+user_ids = get_user_ids(config, outdir)
+user_ids.load_legacy(storage.hashed_ids())
+user_ids.build_checkpoints()
+
+io_executor = IOExecutor(config.get("io_workers", 4))
+loop_monitor = LoopMonitor()
+user_locks = UserLocks()
+legacy_renames = LegacyRenames(user_ids, storage, user_locks, io_executor, user_index)
+background_tasks = []
+api_calls = ApiCallCounter()
 
 developer_chat_id = config["developer_chat_id"]
 bot_token = config["bot_token"]
-exercises = config["exercises"]
+exercise_codes = get_exercise_codes(config, outdir)
+
+
+def build_exercises(
+    new_config: Dict,
+) -> Tuple[ExerciseRegistry, Keyboards, ExerciseMatcher]:
+    """The exercise registry of a config and the keyboards and matcher built from it."""
+    new_registry = get_exercise_registry(new_config)
+    return (
+        new_registry,
+        Keyboards(new_registry, exercise_codes),
+        ExerciseMatcher(new_registry.names),
+    )
+
+
+# replaced as a whole when env.json is reloaded
+registry, keyboards, exercise_matcher = build_exercises(config)
+exercises = registry.names
+reload_lock = asyncio.Lock()
+
+START, KG, REPS, FERTIG, CLEAR_ALL, IMPORT = range(6)
+
+# largest file bots can download from Telegram
+max_upload_bytes = 20 * 1024 * 1024
 
-(START, KG, REPS, FERTIG, CLEAR_ALL) = range(5)
+# the exercise and kg selected with keyboards sent before selections were carried in the callback data
+sessions = get_session_store(config, outdir)
 
-exercise_tmp = dict()
-kg_tmp = dict()
-reps_tmp = dict()
+
+async def hashed_user_id(user_id: int) -> str:
+    """The hashed id of a user, renaming their history from its legacy hashed id on first contact."""
+    return await legacy_renames.hashed_id(user_id)
 
 
 async def start(update: Update, context: CallbackContext) -> int:
@@ -60,12 +124,26 @@ async def report(update: Update, context: CallbackContext) -> int:
     user_id = update.message.from_user.id
     await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
     logger.info(f"user_id: {user_id}")
-    hashed_id = hashlib.md5(bytes(user_id)).hexdigest()
+    hashed_id = await hashed_user_id(user_id)
     logger.info(f"hashed: {hashed_id}")
 
-    df = read_csv(outdir, hashed_id, df_columns)
+    # /report <days> only plots the last days
+    start_time = None
+    if context.args and context.args[0].isdigit():
+        start_time = datetime.now() - timedelta(days=int(context.args[0]))
+
+    try:
+        async with user_locks.hold(hashed_id):
+            df = await io_executor.run(storage.read, hashed_id, start_time)
+    except Exception:
+        # a corrupt history, the error handler notifies the developer
+        await context.bot.send_message(
+            chat_id,
+            "Sorry, I couldn't read your history, the developer has been notified.",
+        )
+        raise
 
-    exercises_list = await plot_exercises(df, hashed_id, chat_id, context)
+    exercises_list = await plot_exercises(df, chat_id, context, io_executor, registry)
 
     if len(exercises_list) == 0:
         await context.bot.send_message(
@@ -75,103 +153,211 @@ async def report(update: Update, context: CallbackContext) -> int:
     return START
 
 
-async def exercise(update: Update, context: CallbackContext) -> int:
+async def export(update: Update, context: CallbackContext) -> int:
+    chat_id = update.message.chat.id
+    user_id = update.message.from_user.id
+    await context.bot.send_chat_action(
+        chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT
+    )
+    hashed_id = await hashed_user_id(user_id)
+
+    # /export jsonl exports JSON Lines instead of CSV
+    export_format = "csv"
+    if context.args and context.args[0].lower() in export_formats:
+        export_format = context.args[0].lower()
+
+    async with user_locks.hold(hashed_id):
+        data, count = await io_executor.run(
+            export_history, storage, hashed_id, export_format
+        )
+
+    if count == 0:
+        await context.bot.send_message(chat_id, "Nothing to export yet.")
+    else:
+        await context.bot.send_document(
+            chat_id,
+            data,
+            filename=export_filename(export_format),
+            caption=f"Your history, {count} entries.",
+        )
+
+    return START
+
+
+async def import_history(update: Update, context: CallbackContext) -> int:
+    await context.bot.send_message(
+        update.message.chat.id,
+        "Send me a CSV file with the columns timestamp, exercise, kg and reps (and optionally group), "
+        "or a JSON Lines file with the same fields, e.g. from /export.\n"
+        "Use -1 or leave kg empty for bodyweight exercises. /cancel to stop.",
+    )
+
+    return IMPORT
+
+
+async def import_document(update: Update, context: CallbackContext) -> int:
     chat_id = update.message.chat.id
+    user_id = update.message.from_user.id
+    document = update.message.document
+    hashed_id = await hashed_user_id(user_id)
+
+    if document.file_size is not None and document.file_size > max_upload_bytes:
+        await context.bot.send_message(
+            chat_id, "That file is too large, the limit is 20 MB."
+        )
+        return IMPORT
+
     await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    upload = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    try:
+        file = await document.get_file()
+        await file.download_to_memory(upload)
+        upload.seek(0)
+        result = await io_executor.run(
+            parse_upload, upload, registry, config.get("max_import_rows", 100000)
+        )
+    except (ValueError, EOFError, OSError, csv.Error) as e:
+        logger.warning(f"Unreadable upload: {e}")
+        await context.bot.send_message(
+            chat_id, "I couldn't read that file, please send a CSV or JSON Lines file."
+        )
+        return IMPORT
+    finally:
+        upload.close()
 
-    keyboard = [InlineKeyboardButton(d, callback_data=d) for d in exercises]
+    if result.error_count > 0:
+        await context.bot.send_message(
+            chat_id,
+            f"Nothing imported, please fix these rows and send the file again:\n{format_errors(result)}",
+        )
+        return IMPORT
 
-    chunk_size = 2
-    chunks = [keyboard[x : x + chunk_size] for x in range(0, len(keyboard), chunk_size)]
+    if not result.rows:
+        await context.bot.send_message(chat_id, "That file has no sets in it.")
+        return IMPORT
 
-    reply_markup = InlineKeyboardMarkup(chunks)
+    # one batched write of all rows
+    async with user_locks.hold(hashed_id):
+        await io_executor.run(storage.append, hashed_id, result.rows)
 
+    first, last = result.rows[0][1], result.rows[-1][1]
     await context.bot.send_message(
-        chat_id, "Good job! What exercise did you just do?", reply_markup=reply_markup
+        chat_id,
+        f"Imported {len(result.rows)} sets from {first:%d.%m.%Y} to {last:%d.%m.%Y}.",
+    )
+
+    return START
+
+
+async def exercise(update: Update, context: CallbackContext) -> int:
+    chat_id = update.message.chat.id
+
+    await context.bot.send_message(
+        chat_id,
+        "Good job! What exercise did you just do?",
+        reply_markup=keyboards.exercises,
     )
 
     return KG
 
 
+async def decode_callback(query: CallbackQuery) -> Optional[Selection]:
+    """The selection carried by a callback query, None if its keyboard was sent before selections
+    were encoded in the callback data or the exercise code is unknown."""
+    selection = decode_selection(query.data)
+    if selection is None:
+        return None
+    try:
+        # unknown codes were added by another process, decoding them reads the codes file
+        await io_executor.run(exercise_codes.decode, selection.code)
+    except IndexError:
+        logger.warning(f"Unknown exercise code in callback data: {query.data}")
+        return None
+    return selection
+
+
 async def kg(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
-    chat_id = query.message.chat.id
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
     user_id = query.from_user.id
     logger.info(f"user_id: {user_id}")
 
     await query.answer()
 
-    exercise_tmp[user_id] = query.data
-
-    if query.data in [
-        "Walking Lunges",
-        "Dumbbell Rows",
-        "Shoulder Press",
-        "Biceps Curl",
-        "Triceps Extension",
-    ]:
-        kg_range = range(5, 41, 1)
-    elif query.data in [
-        "Pullup overhand",
-        "Pullup underhand",
-        "Pushup",
-        "The Countdown",
-        "Hanging Leg Raise"
-    ]:
-        kg_tmp[user_id] = -1
-        return await reps(update, context)
-    else:
-        kg_range = range(20, 205, 5)
+    selection = await decode_callback(query)
+    if selection is None:
+        # older keyboards sent the exercise name
+        if query.data not in exercises:
+            return await session_expired(update, context)
+        selection = Selection(exercise_codes.encode(query.data))
+    reply_markup = keyboards.kg(selection)
+    if reply_markup is None:
+        return await ask_reps(update, context, selection._replace(kg=-1))
 
-    keyboard = [InlineKeyboardButton(str(d), callback_data=str(d)) for d in kg_range]
-
-    chunk_size = 5
-    chunks = [keyboard[x : x + chunk_size] for x in range(0, len(keyboard), chunk_size)]
-
-    reply_markup = InlineKeyboardMarkup(chunks)
-
-    await query.delete_message()
-
-    await context.bot.send_message(chat_id, "How many kg?", reply_markup=reply_markup)
+    await query.edit_message_text("How many kg?", reply_markup=reply_markup)
 
     return REPS
 
 
 async def reps(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
-    chat_id = query.message.chat.id
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
     user_id = query.from_user.id
     logger.info(f"user_id: {user_id}")
 
     await query.answer()
 
-    kg_tmp[user_id] = query.data
+    selection = await decode_callback(query)
+    if selection is None:
+        # older keyboards sent the kg, the exercise was kept in the session store
+        session = await io_executor.run(sessions.pop, user_ids.hashed(user_id))
+        if session is None or session["exercise"] not in exercises:
+            return await session_expired(update, context)
+        selection = Selection(exercise_codes.encode(session["exercise"]), query.data)
+
+    return await ask_reps(update, context, selection)
+
+
+async def session_expired(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    await query.edit_message_text(
+        "Sorry, that took too long and I forgot the exercise. Please start again with /exercise."
+    )
+
+    return START
+
+
+async def ask_reps(
+    update: Update, context: CallbackContext, selection: Selection
+) -> int:
+    """Asks for the reps, for bodyweight exercises right after the exercise was selected."""
+    query = update.callback_query
+
+    await query.edit_message_text(
+        "How many reps?", reply_markup=keyboards.reps(selection)
+    )
 
-    keyboard = [
-        InlineKeyboardButton(str(d), callback_data=str(d)) for d in range(1, 51)
-    ]
+    return FERTIG
 
-    chunk_size = 5
-    chunks = [keyboard[x : x + chunk_size] for x in range(0, len(keyboard), chunk_size)]
 
-    reply_markup = InlineKeyboardMarkup(chunks)
+async def choose_sets(update: Update, context: CallbackContext) -> int:
+    """Marks how many identical sets the reps keyboard logs."""
+    query = update.callback_query
 
-    await query.delete_message()
+    await query.answer()
 
-    await context.bot.send_message(chat_id, "How many reps?", reply_markup=reply_markup)
+    selection = await decode_callback(query)
+    if selection is None:
+        return await session_expired(update, context)
+    await query.edit_message_reply_markup(keyboards.reps(selection))
 
     return FERTIG
 
 
 async def fertig(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
-    chat_id = query.message.chat.id
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
     user_id = query.from_user.id
     logger.info(f"user_id: {user_id}")
-    logger.info(f"hashed: {hashlib.md5(bytes(user_id)).hexdigest()}")
+    hashed_id = await hashed_user_id(user_id)
+    logger.info(f"hashed: {hashed_id}")
 
     try:
         if "group" in query.message.chat.type:
@@ -184,46 +370,129 @@ async def fertig(update: Update, context: CallbackContext) -> int:
 
     await query.answer()
 
-    reps_tmp[user_id] = query.data
+    selection = await decode_callback(query)
+    if selection is not None and None not in (selection.kg, selection.reps):
+        exercise_name = exercise_codes.decode(selection.code)
+        kg_value, reps_value, sets_value = selection.kg, selection.reps, selection.sets
+    else:
+        # older keyboards sent the reps, the exercise and kg were kept in the session store
+        session = await io_executor.run(sessions.pop, user_ids.hashed(user_id))
+        if session is None:
+            return await session_expired(update, context)
+        exercise_name, kg_value = session["exercise"], session["kg"]
+        reps_value, sets_value = query.data, 1
+    if not keyboards.offers(exercise_name, kg_value, reps_value, sets_value):
+        logger.warning(
+            f"Callback data of a set the keyboards don't offer: {query.data}"
+        )
+        await query.edit_message_text(
+            "Sorry, I can't log that. Please start again with /exercise."
+        )
+        return START
+
+    row = (is_group, datetime.now(), exercise_name, kg_value, reps_value)
+    # all sets in one write
+    async with user_locks.hold(hashed_id):
+        await io_executor.run(storage.append, hashed_id, [row] * sets_value)
 
-    data_row = ",".join(
-        [
-            str(is_group),
-            str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-            exercise_tmp[user_id],
-            kg_tmp[user_id],
-            reps_tmp[user_id],
-        ]
+    await query.edit_message_text(
+        f"Exercise saved: {set_line(exercise_name, kg_value, reps_value, sets_value)}",
+        reply_markup=keyboards.again,
     )
 
-    with open(
-        os.path.join(outdir, hashlib.md5(bytes(user_id)).hexdigest()) + ".csv", "a"
-    ) as file:
-        file.write(data_row + "\n")
+    return START
 
-    if kg_tmp[user_id] == -1:
-        exercise_line = ", ".join([exercise_tmp[user_id], reps_tmp[user_id] + " reps"])
-    else:
-        exercise_line = ", ".join(
-            [
-                exercise_tmp[user_id],
-                kg_tmp[user_id] + " kg",
-                reps_tmp[user_id] + " reps",
-            ]
-        )
 
-    await query.delete_message()
+def set_line(exercise_name: str, kg_value, reps_value: str, sets_value: int = 1) -> str:
+    """How logged sets are shown to the user."""
+    fields = [exercise_name]
+    if str(kg_value) != "-1":
+        fields.append(str(kg_value) + " kg")
+    fields.append(reps_value + " reps")
+    if sets_value > 1:
+        fields.append(f"{sets_value} sets")
+    return ", ".join(fields)
+
+
+async def log(update: Update, context: CallbackContext) -> int:
+    """Logs sets given in one message, e.g. /log squat 100x5."""
+    return await quick_log(update, context, " ".join(context.args or []))
+
+
+async def log_text(update: Update, context: CallbackContext) -> int:
+    """Logs sets sent as a plain text message, e.g. squat 100x5."""
+    return await quick_log(update, context, update.message.text)
+
+
+async def quick_log(update: Update, context: CallbackContext, text: str) -> int:
+    chat_id = update.message.chat.id
+    user_id = update.message.from_user.id
+    logger.info(f"user_id: {user_id}")
+
+    try:
+        logged = parse_quick_log(text, exercise_matcher, registry)
+    except ValueError as e:
+        await context.bot.send_message(chat_id, str(e))
+        return START
+
+    hashed_id = await hashed_user_id(user_id)
+    logger.info(f"hashed: {hashed_id}")
+    is_group = "group" in update.message.chat.type
+    row = (is_group, datetime.now(), logged.exercise, logged.kg, logged.reps)
+
+    # all sets in one write
+    async with user_locks.hold(hashed_id):
+        await io_executor.run(storage.append, hashed_id, [row] * logged.sets)
 
+    line = set_line(logged.exercise, logged.kg, logged.reps, logged.sets)
     await context.bot.send_message(
-        chat_id,
-        f"Exercise saved: {exercise_line}",
+        chat_id, f"Exercise saved: {line}", reply_markup=keyboards.again
     )
 
     return START
 
 
+async def again(update: Update, context: CallbackContext) -> None:
+    """Logs the last set again with the current time, for /again and the Same again button.
+
+    The last set comes from memory right after logging it, the history is only read after a restart.
+    Both work in any state of the conversation without changing it.
+    """
+    query = update.callback_query
+    message = query.message if query is not None else update.message
+    chat_id = message.chat.id
+    user_id = update.effective_user.id
+    logger.info(f"user_id: {user_id}")
+    hashed_id = await hashed_user_id(user_id)
+    logger.info(f"hashed: {hashed_id}")
+
+    if query is not None:
+        await query.answer()
+
+    async with user_locks.hold(hashed_id):
+        last = await io_executor.run(storage.last_row, hashed_id)
+        if last is not None:
+            is_group = "group" in message.chat.type
+            _, _, exercise_name, kg_value, reps_value = last
+            row = (is_group, datetime.now(), exercise_name, kg_value, reps_value)
+            await io_executor.run(storage.append, hashed_id, [row])
+
+    if last is None:
+        await context.bot.send_message(
+            chat_id, "There is no set to repeat yet, log one with /exercise or /log."
+        )
+        return
+
+    await context.bot.send_message(
+        chat_id,
+        f"Exercise saved: {set_line(exercise_name, kg_value, reps_value)}",
+        reply_markup=keyboards.again,
+    )
+
+
 async def cancel(update: Update, context: CallbackContext) -> int:
     """Cancels the current operation."""
+    await io_executor.run(sessions.pop, user_ids.hashed(update.message.from_user.id))
 
     await context.bot.send_message(
         update.message.chat.id, "Current operation cancelled."
@@ -243,33 +512,24 @@ async def delete_last_entry(update: Update, context: CallbackContext) -> int:
     chat_id = update.message.chat.id
     await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
     user_id = update.message.from_user.id
-    hashed_id = hashlib.md5(bytes(user_id)).hexdigest()
+    hashed_id = await hashed_user_id(user_id)
 
-    with open(os.path.join(outdir, hashed_id) + ".csv", "r") as fp:
-        lines = fp.readlines()
+    async with user_locks.hold(hashed_id):
+        deleted = await io_executor.run(storage.delete_last, hashed_id)
 
-    with open(os.path.join(outdir, hashed_id) + ".csv", "w") as fp:
-        for number, line in enumerate(lines):
-            if number != len(lines) - 1:
-                fp.write(line)
-
-    await context.bot.send_message(chat_id, "Last entry deleted.")
+    if deleted:
+        await context.bot.send_message(chat_id, "Last entry deleted.")
+    else:
+        await context.bot.send_message(chat_id, "Nothing to delete.")
 
     return START
 
 
 async def clear_all(update: Update, context: CallbackContext) -> int:
-    keyboard = [InlineKeyboardButton(d, callback_data=d) for d in ["Yes", "No"]]
-
-    chunk_size = 2
-    chunks = [keyboard[x : x + chunk_size] for x in range(0, len(keyboard), chunk_size)]
-
-    reply_markup = InlineKeyboardMarkup(chunks)
-
     await context.bot.send_message(
         update.message.chat.id,
         "You sure?! This will delete all entries!",
-        reply_markup=reply_markup,
+        reply_markup=keyboards.clear_all,
     )
 
     return CLEAR_ALL
@@ -281,12 +541,13 @@ async def clear_all_for_real(update: Update, context: CallbackContext) -> int:
     await context.bot.send_chat_action(
         chat_id=query.message.chat_id, action=ChatAction.TYPING
     )
-    hashed_id = hashlib.md5(bytes(user_id)).hexdigest()
+    hashed_id = await hashed_user_id(user_id)
 
     await query.answer()
 
     if query.data == "Yes":
-        os.remove(os.path.join(outdir, f"{hashed_id}.csv"))
+        async with user_locks.hold(hashed_id):
+            await io_executor.run(storage.delete_all, hashed_id)
         await query.edit_message_text(text=f"Removed all entries.")
     else:
         await query.edit_message_text(text=f"All right, nothing removed this time.")
@@ -294,16 +555,144 @@ async def clear_all_for_real(update: Update, context: CallbackContext) -> int:
     return START
 
 
+async def compact_histories(interval: float) -> None:
+    """Let the storage engine roll over or compact every user's history, every interval seconds."""
+    while True:
+        hashed_ids = await io_executor.run(list, storage.hashed_ids())
+        compacted = 0
+        for hashed_id in hashed_ids:
+            async with user_locks.hold(hashed_id):
+                compacted += await io_executor.run(storage.compact, hashed_id)
+        if compacted > 0:
+            logger.warning(f"Compacted {compacted} histories")
+        await asyncio.sleep(interval)
+
+
+async def build_user_index() -> None:
+    """Count every user's history into the user index, users writing meanwhile are indexed anyway."""
+    hashed_ids = await io_executor.run(list, storage.hashed_ids())
+    for hashed_id in hashed_ids:
+        async with user_locks.hold(hashed_id):
+            await io_executor.run(
+                user_index.count_rows, hashed_id, storage.iter_rows(hashed_id)
+            )
+    await io_executor.run(user_index.mark_built)
+    logger.warning(f"Indexed {len(hashed_ids)} users")
+
+
+async def reload_exercises() -> None:
+    """Rebuild the exercises, their settings and keyboards from env.json.
+
+    Conversations in progress carry on, their keyboards refer to exercises by their stable codes.
+    Other settings are only read on startup.
+    """
+    global registry, keyboards, exercise_matcher, exercises
+    async with reload_lock:
+        try:
+            new_config = await io_executor.run(read_config, outdir)
+            new_exercises = await io_executor.run(build_exercises, new_config)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Reloading the exercises failed, keeping the old ones: {e!r}")
+            return
+        registry, keyboards, exercise_matcher = new_exercises
+        exercises = registry.names
+    logger.warning(f"Reloaded {len(exercises)} exercises")
+
+
+async def watch_config(interval: float) -> None:
+    """Reload the exercises whenever env.json changes, checked every interval seconds."""
+    path = os.path.join(outdir, "env.json")
+    version = await io_executor.run(file_version, path)
+    while True:
+        await asyncio.sleep(interval)
+        current = await io_executor.run(file_version, path)
+        if current != version:
+            version = current
+            await reload_exercises()
+
+
+async def start_background_tasks(application: Application) -> None:
+    """Start measuring how long the event loop is blocked, move flat files into shards, build the
+    user index, start compacting histories and reload the exercises on SIGHUP or changes.
+    """
+    loop_monitor.start()
+    loop = asyncio.get_running_loop()
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(
+            signal.SIGHUP,
+            lambda: background_tasks.append(loop.create_task(reload_exercises())),
+        )
+    reload_interval = config.get("config_reload_interval", 30)
+    if reload_interval > 0:
+        background_tasks.append(loop.create_task(watch_config(reload_interval)))
+    if resolver.flat_files_left:
+        loop.run_in_executor(
+            io_executor.pool, resolver.migrate_flat_files, user_file_suffixes
+        )
+    if user_index is not None and not user_index.built:
+        background_tasks.append(loop.create_task(build_user_index()))
+    if config.get("archive_segments", False):
+        background_tasks.append(
+            loop.create_task(compact_histories(config.get("compaction_interval", 3600)))
+        )
+
+
+async def stop_background_tasks(application: Application) -> None:
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await loop_monitor.stop()
+
+
+async def close_storage(application: Application) -> None:
+    """Wait for pending I/O and close the storage engine when the bot shuts down."""
+    legacy_renames.shutdown()
+    io_executor.shutdown()
+    storage.close()
+    logger.warning(f"Sessions: {sessions.stats()}")
+    logger.warning(f"API calls: {api_calls.stats()}")
+    sessions.close()
+
+
 def main() -> None:
     """Setup and run the bot."""
     # Create the Updater and pass it your bot's token.
-    application = ApplicationBuilder().token(bot_token).build()
+    builder = (
+        ApplicationBuilder()
+        .token(bot_token)
+        .request(CountingRequest(connection_pool_size=256))
+        .post_init(start_background_tasks)
+        .post_stop(stop_background_tasks)
+        .post_shutdown(close_storage)
+    )
+    if config.get("concurrent_updates", 0) > 0:
+        builder = builder.concurrent_updates(
+            PerUserUpdateProcessor(config["concurrent_updates"])
+        )
+    persistence = get_persistence(
+        config, outdir, sessions, io_executor.pool, resting_states=[START]
+    )
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
+
+    log_handlers = [CommandHandler("log", log)]
+    if config.get("quick_log_text", False):
+        # only in private chats, messages in groups are meant for the other members
+        log_handlers.append(
+            MessageHandler(
+                filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, log_text
+            )
+        )
 
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("start", start),
             CommandHandler("exercise", exercise),
+            *log_handlers,
             CommandHandler("report", report),
+            CommandHandler("export", export),
+            CommandHandler("import", import_history),
             CommandHandler("delete_last_entry", delete_last_entry),
             CommandHandler("clear_all", clear_all),
         ],
@@ -311,19 +700,34 @@ def main() -> None:
             START: [
                 CommandHandler("start", start),
                 CommandHandler("exercise", exercise),
+                *log_handlers,
                 CommandHandler("report", report),
+                CommandHandler("export", export),
+                CommandHandler("import", import_history),
                 CommandHandler("delete_last_entry", delete_last_entry),
                 CommandHandler("clear_all", clear_all),
             ],
             KG: [CallbackQueryHandler(kg)],
             REPS: [CallbackQueryHandler(reps)],
-            FERTIG: [CallbackQueryHandler(fertig)],
+            FERTIG: [
+                CallbackQueryHandler(choose_sets, pattern=is_sets_choice),
+                CallbackQueryHandler(fertig),
+            ],
             CLEAR_ALL: [CallbackQueryHandler(clear_all_for_real)],
+            IMPORT: [MessageHandler(filters.Document.ALL, import_document)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="gymbot",
+        persistent=persistence is not None,
     )
 
+    # count the Bot API calls made for every update around all other handlers
+    application.add_handler(TypeHandler(Update, api_calls.start), group=-1)
+    # repeating the last set doesn't depend on or change the state of the conversation
+    application.add_handler(CommandHandler("again", again))
+    application.add_handler(CallbackQueryHandler(again, pattern=f"^{again_data}$"))
     application.add_handler(conv_handler)
+    application.add_handler(TypeHandler(Update, api_calls.finish), group=1)
 
     application.add_error_handler(error_handler)
 
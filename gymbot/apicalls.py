@@ -0,0 +1,60 @@
+import logging
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from telegram import Update
+from telegram.ext import CallbackContext
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# the Bot API methods called while handling the current update, None outside of updates
+update_calls: ContextVar[Optional[Counter]] = ContextVar("update_calls", default=None)
+
+
+class CountingRequest(HTTPXRequest):
+    """HTTPXRequest that counts the Bot API methods called while an update is handled."""
+
+    async def do_request(self, url: str, method: str, *args: Any, **kwargs: Any):
+        calls = update_calls.get()
+        if calls is not None:
+            calls[url.rsplit("/", 1)[-1]] += 1
+        return await super().do_request(url, method, *args, **kwargs)
+
+
+class ApiCallCounter:
+    """Counts the outbound Bot API calls per update.
+
+    start() and finish() are registered as TypeHandlers in groups before and after the bot's
+    handlers; every update is handled in one task, so the calls made in between are its own.
+    """
+
+    def __init__(self):
+        self.updates = 0
+        self.calls: Counter = Counter()
+        self.max_calls = 0
+
+    async def start(self, update: Update, context: CallbackContext) -> None:
+        update_calls.set(Counter())
+
+    async def finish(self, update: Update, context: CallbackContext) -> None:
+        calls = update_calls.get()
+        update_calls.set(None)
+        if calls is None:
+            return
+        total = sum(calls.values())
+        logger.info(f"Update {update.update_id}: {total} API calls {dict(calls)}")
+        self.updates += 1
+        self.calls.update(calls)
+        self.max_calls = max(self.max_calls, total)
+
+    def stats(self) -> Dict[str, Any]:
+        total = sum(self.calls.values())
+        return {
+            "updates": self.updates,
+            "calls": total,
+            "per_update": round(total / self.updates, 2) if self.updates else 0,
+            "max_per_update": self.max_calls,
+            "methods": dict(self.calls.most_common()),
+        }
@@ -0,0 +1,111 @@
+import argparse
+import os
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+from gymbot.callbacks import Selection, encode_selection
+from gymbot.columnar import ColumnarStorage, ExerciseCodes, convert_csv_files
+from gymbot.exercises import ExerciseRegistry
+from gymbot.keyboards import Keyboards, build_markup, reps_range
+from gymbot.storage import CsvStorage
+
+exercises = ["Squat", "Bench Press", "Deadlift", "Pushup", "Biceps Curl"]
+
+
+def write_history(outdir: str, hashed_id: str, rows: int) -> None:
+    """Write a synthetic CSV history of the given length."""
+    start = datetime(2020, 1, 1, 18)
+    CsvStorage(outdir).append(
+        hashed_id,
+        [
+            (
+                False,
+                start + timedelta(hours=6 * i),
+                exercises[i % len(exercises)],
+                str(20 + i % 100),
+                str(1 + i % 12),
+            )
+            for i in range(rows)
+        ],
+    )
+
+
+def bench_reads(rows: int, repeat: int) -> None:
+    """Compare reading one user's history from CSV and from the columnar format."""
+    with tempfile.TemporaryDirectory() as outdir:
+        write_history(outdir, "user", rows)
+        codes = ExerciseCodes(os.path.join(outdir, "exercise_codes.json"), exercises)
+        convert_csv_files(outdir, codes)
+
+        csv_storage = CsvStorage(outdir)
+        columnar_storage = ColumnarStorage(outdir, codes)
+        for name, storage in [("csv", csv_storage), ("columnar", columnar_storage)]:
+            seconds = min(
+                timeit.repeat(lambda: storage.read("user"), number=1, repeat=repeat)
+            )
+            print(f"{rows:>8} rows  {name:<10} {seconds * 1000:8.2f} ms")
+
+
+def build_keyboards(codes: ExerciseCodes, selection: Selection) -> None:
+    """Build the keyboards of logging one set per request, like the handlers did before the registry."""
+    build_markup(
+        [(name, encode_selection(Selection(codes.encode(name)))) for name in exercises],
+        2,
+    )
+    kgs = range(20, 205, 5)
+    build_markup(
+        [(str(d), encode_selection(selection._replace(kg=str(d)))) for d in kgs], 5
+    )
+    build_markup(
+        [
+            (str(d), encode_selection(selection._replace(reps=str(d))))
+            for d in reps_range
+        ],
+        5,
+    )
+
+
+def cached_keyboards(keyboards: Keyboards, selection: Selection) -> None:
+    keyboards.exercises
+    keyboards.kg(selection)
+    keyboards.reps(selection)
+
+
+def bench_keyboards(repeat: int, number: int = 1000) -> None:
+    """Compare the CPU time of the keyboards of logging one set built per request and from Keyboards."""
+    with tempfile.TemporaryDirectory() as outdir:
+        codes = ExerciseCodes(os.path.join(outdir, "exercise_codes.json"), exercises)
+        keyboards = Keyboards(ExerciseRegistry(exercises), codes)
+        selection = Selection(codes.encode("Squat"), "100")
+        for name, func in [
+            ("built", lambda: build_keyboards(codes, selection)),
+            ("cached", lambda: cached_keyboards(keyboards, selection)),
+        ]:
+            seconds = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+            print(f"keyboards  {name:<10} {seconds * 1e6:8.2f} us per set")
+
+
+def main() -> None:
+    """Micro-benchmarks of the storage read paths and the keyboards of the handlers."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--benchmark",
+        action="append",
+        choices=["reads", "keyboards"],
+        help="run only this benchmark, can be repeated",
+    )
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    benchmarks = args.benchmark or ["reads", "keyboards"]
+
+    if "reads" in benchmarks:
+        for rows in args.rows:
+            bench_reads(rows, args.repeat)
+    if "keyboards" in benchmarks:
+        bench_keyboards(args.repeat)
+
+
+if __name__ == "__main__":
+    main()
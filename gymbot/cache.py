@@ -0,0 +1,128 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, NamedTuple, Optional, Tuple
+
+import pandas as pd
+
+
+class CacheEntry(NamedTuple):
+    version: Hashable
+    df: pd.DataFrame
+    nbytes: int
+    # engine specific state for extending df, e.g. the CSV offset parsed to
+    position: Any
+
+
+class HistoryCache:
+    """Bounded LRU cache of parsed per-user histories.
+
+    Entries are keyed by hashed id and tagged with the version of the stored history they were
+    parsed from; get() only returns an entry if the version still matches. A stale entry stays until
+    it is replaced, so the storage engine can extend it instead of parsing the whole history again.
+    The least recently used entries are evicted once the frames take more than `max_bytes`. Cached
+    frames are shared between callers and must not be modified in place.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, hashed_id: str, version: Hashable) -> Optional[pd.DataFrame]:
+        with self.lock:
+            entry = self.entries.get(hashed_id)
+            if entry is None or entry.version != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(hashed_id)
+            self.hits += 1
+            return entry.df
+
+    def stale(self, hashed_id: str) -> Optional[CacheEntry]:
+        """The entry of a user regardless of its version."""
+        with self.lock:
+            return self.entries.get(hashed_id)
+
+    def put(
+        self, hashed_id: str, version: Hashable, df: pd.DataFrame, position: Any = None
+    ) -> None:
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        with self.lock:
+            self._remove(hashed_id)
+            if nbytes > self.max_bytes:
+                return
+            self.entries[hashed_id] = CacheEntry(version, df, nbytes, position)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, hashed_id: str) -> None:
+        with self.lock:
+            self._remove(hashed_id)
+
+    def _remove(self, hashed_id: str) -> None:
+        entry = self.entries.pop(hashed_id, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class LastRows:
+    """Bounded LRU cache of the last stored row of each user.
+
+    A None row means the user is known to have no rows. At most `max_users` users are kept, the
+    least recently used are evicted first.
+    """
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self.rows: "OrderedDict[str, Optional[Tuple]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, hashed_id: str) -> Tuple[bool, Optional[Tuple]]:
+        """Whether the last row of a user is known, and the row."""
+        with self.lock:
+            if hashed_id not in self.rows:
+                self.misses += 1
+                return False, None
+            self.rows.move_to_end(hashed_id)
+            self.hits += 1
+            return True, self.rows[hashed_id]
+
+    def put(self, hashed_id: str, row: Optional[Tuple]) -> None:
+        with self.lock:
+            self.rows[hashed_id] = row
+            self.rows.move_to_end(hashed_id)
+            while len(self.rows) > self.max_users:
+                self.rows.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, hashed_id: str) -> None:
+        with self.lock:
+            self.rows.pop(hashed_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "users": len(self.rows),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
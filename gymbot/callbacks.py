@@ -0,0 +1,64 @@
+from typing import NamedTuple, Optional, Union
+
+# callback data of the logging keyboards starts with this, older keyboards sent plain values
+prefix = "#"
+
+# Telegram rejects buttons with longer callback data
+max_callback_bytes = 64
+
+# the numbers of identical sets offered above the reps
+sets_range = range(1, 6)
+
+
+class Selection(NamedTuple):
+    """What a user selected so far while logging a set, carried in the callback data of the next
+    keyboard so any process can handle the next step without a session."""
+
+    code: int
+    # -1 for bodyweight exercises, None until selected
+    kg: Union[str, int, None] = None
+    reps: Optional[str] = None
+    # identical sets to log at once
+    sets: int = 1
+
+
+def encode_selection(selection: Selection) -> str:
+    """Compact callback data of a selection, e.g. `#3:100:5` for exercise code 3, 100 kg and 5 reps
+    or `#3:100:5:4` for 4 such sets. Fields not selected yet are left empty or out at the end.
+    """
+    fields = [
+        str(selection.code),
+        "" if selection.kg is None else str(selection.kg),
+        selection.reps or "",
+        "" if selection.sets == 1 else str(selection.sets),
+    ]
+    while fields[-1] == "":
+        fields.pop()
+    data = prefix + ":".join(fields)
+    if len(data.encode()) > max_callback_bytes:
+        raise ValueError(f"Callback data too long: {data}")
+    return data
+
+
+def decode_selection(data: Optional[str]) -> Optional[Selection]:
+    """The selection of callback data, None for data of keyboards sent before it was encoded."""
+    if not data or not data.startswith(prefix):
+        return None
+    fields = data[len(prefix) :].split(":") + ["", "", ""]
+    try:
+        code = int(fields[0])
+        sets = int(fields[3] or 1)
+    except ValueError:
+        return None
+    if code < 0 or sets not in sets_range:
+        return None
+    kg: Union[str, int, None] = fields[1] or None
+    if kg == "-1":
+        kg = -1
+    return Selection(code, kg, fields[2] or None, sets)
+
+
+def is_sets_choice(data: object) -> bool:
+    """Whether callback data is a choice of the number of sets on the reps keyboard."""
+    selection = decode_selection(data) if isinstance(data, str) else None
+    return selection is not None and selection.kg is not None and selection.reps is None
@@ -0,0 +1,76 @@
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, List, Sequence
+
+from gymbot.locks import flock
+
+
+class ExerciseCodes:
+    """Stable mapping between exercise names and small integer codes.
+
+    Seeded from config["exercises"] and persisted in `<outdir>/exercise_codes.json`. Codes are
+    never reused: names that are not known yet get the next free code, so removing an exercise
+    from the config does not change the meaning of stored records.
+    """
+
+    def __init__(self, path: str, exercises: Sequence[str] = ()):
+        self.path = path
+        self.lock = threading.Lock()
+        self._load()
+        if any(name not in self.codes for name in exercises):
+            for name in exercises:
+                self.encode(name)
+
+    def _load(self) -> None:
+        try:
+            with open(self.path) as file:
+                self.names = json.load(file)
+        except FileNotFoundError:
+            self.names = []
+        self.codes = {name: code for code, name in enumerate(self.names)}
+
+    def encode(self, name: str) -> int:
+        code = self.codes.get(name)
+        if code is not None:
+            return code
+        # other processes may have added names since, e.g. parallel migration workers
+        with self.lock, flock(self.path + ".lock"):
+            self._load()
+            if name not in self.codes:
+                self.codes[name] = len(self.names)
+                self.names.append(name)
+                self._save()
+            return self.codes[name]
+
+    def decode(self, code: int) -> str:
+        if code < 0:
+            raise IndexError(f"Exercise code {code} is negative")
+        if code >= len(self.names):
+            self.refresh()
+        return self.names[code]
+
+    def decode_all(self, codes: Sequence[int]) -> List[str]:
+        if len(codes) > 0 and max(codes) >= len(self.names):
+            self.refresh()
+        return [self.names[code] for code in codes]
+
+    def refresh(self) -> None:
+        """Pick up names added by other processes."""
+        with self.lock:
+            self._load()
+
+    def _save(self) -> None:
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.path) or ".", suffix=".tmp"
+        )
+        with os.fdopen(fd, "w") as file:
+            json.dump(self.names, file)
+        os.replace(tmp_path, self.path)
+
+
+def get_exercise_codes(config: Dict, outdir: str) -> ExerciseCodes:
+    return ExerciseCodes(
+        os.path.join(outdir, "exercise_codes.json"), config["exercises"]
+    )
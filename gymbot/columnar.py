@@ -0,0 +1,240 @@
+import argparse
+import os
+from datetime import datetime
+from typing import Hashable, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from gymbot.codes import ExerciseCodes, get_exercise_codes
+from gymbot.paths import PathResolver, get_path_resolver
+from gymbot.storage import (
+    CsvStorage,
+    Row,
+    Storage,
+    df_columns,
+    file_version,
+    from_epoch,
+    to_epoch,
+)
+from gymbot.tools import read_config
+
+# Fixed-width record of one set, stored packed and little-endian in `<hashed_id>.rec`.
+record_dtype = np.dtype(
+    [
+        ("timestamp", "<i8"),
+        ("exercise", "<u2"),
+        ("kg", "<f4"),
+        ("reps", "<u2"),
+        ("group", "u1"),
+    ]
+)
+
+
+def to_kg(kg) -> float:
+    """Bodyweight entries are stored as -1, also the ones older versions logged with the exercise
+    name as kg."""
+    try:
+        kg = float(kg)
+    except (TypeError, ValueError):
+        return -1.0
+    return -1.0 if np.isnan(kg) else kg
+
+
+def stored_kg(kg: np.ndarray) -> np.ndarray:
+    """Float64 kg of records, files written by earlier versions have NaN for bodyweight entries."""
+    kg = kg.astype(np.float64)
+    kg[np.isnan(kg)] = -1
+    return kg
+
+
+class ColumnarStorage(Storage):
+    """One fixed-width binary record file per user, read through a memory map.
+
+    Reports do no text parsing: the columns of the history are copied straight out of the mapped
+    file, and the exercise names are a categorical built from the codes. Deleting the last entry truncates one
+    record.
+    """
+
+    def __init__(
+        self,
+        outdir: str,
+        codes: ExerciseCodes,
+        resolver: Optional[PathResolver] = None,
+    ):
+        self.outdir = outdir
+        self.codes = codes
+        self.resolver = resolver or PathResolver(outdir)
+
+    def path(self, hashed_id: str) -> str:
+        return self.resolver.path(hashed_id, ".rec")
+
+    def records(self, hashed_id: str) -> np.ndarray:
+        """Memory map all complete records of a user, an empty array if there are none."""
+        try:
+            count = os.path.getsize(self.path(hashed_id)) // record_dtype.itemsize
+        except FileNotFoundError:
+            count = 0
+        if count == 0:
+            return np.empty(0, dtype=record_dtype)
+        return np.memmap(
+            self.path(hashed_id), dtype=record_dtype, mode="r", shape=(count,)
+        )
+
+    def encode(self, rows: Sequence[Row]) -> np.ndarray:
+        records = np.empty(len(rows), dtype=record_dtype)
+        for i, (group, timestamp, exercise, kg, reps) in enumerate(rows):
+            records[i] = (
+                to_epoch(timestamp),
+                self.codes.encode(exercise),
+                to_kg(kg),
+                int(reps),
+                bool(group),
+            )
+        return records
+
+    def append(self, hashed_id: str, rows: Sequence[Row]) -> None:
+        self.append_records(hashed_id, self.encode(rows))
+
+    def append_records(self, hashed_id: str, records: np.ndarray) -> None:
+        with open(self.path(hashed_id), "ab") as file:
+            # drop a partial record left behind by an interrupted write
+            partial = file.tell() % record_dtype.itemsize
+            if partial:
+                file.truncate(file.tell() - partial)
+                file.seek(0, os.SEEK_END)
+            file.write(records.astype(record_dtype, copy=False).tobytes())
+
+    def frame(self, records: np.ndarray) -> pd.DataFrame:
+        if len(records) > 0 and records["exercise"].max() >= len(self.codes.names):
+            self.codes.refresh()
+        return pd.DataFrame(
+            {
+                "group": records["group"].astype(bool),
+                "timestamp": records["timestamp"].astype("datetime64[s]"),
+                "exercise": pd.Categorical.from_codes(
+                    records["exercise"].astype(np.int32), categories=self.codes.names
+                ),
+                # copies in the dtypes of the other engines, so the frame also stays valid when
+                # the file is truncated later
+                "kg": stored_kg(records["kg"]),
+                "reps": records["reps"].astype(np.int32),
+            },
+            columns=df_columns,
+        )
+
+    def read(
+        self,
+        hashed_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> pd.DataFrame:
+        records = self.records(hashed_id)
+        if start is not None:
+            records = records[records["timestamp"] >= to_epoch(start)]
+        if end is not None:
+            records = records[records["timestamp"] < to_epoch(end)]
+        return self.frame(records)
+
+    def tail(self, hashed_id: str, n: int = 1) -> pd.DataFrame:
+        return self.frame(self.records(hashed_id)[-n:])
+
+    def version(self, hashed_id: str) -> Hashable:
+        return file_version(self.path(hashed_id))
+
+    def iter_rows(self, hashed_id: str, batch_size: int = 4096) -> Iterator[Row]:
+        records = self.records(hashed_id)
+        for start in range(0, len(records), batch_size):
+            for timestamp, exercise, kg, reps, group in records[
+                start : start + batch_size
+            ]:
+                yield (
+                    bool(group),
+                    from_epoch(timestamp),
+                    self.codes.decode(exercise),
+                    # the shortest repr that reads back as the same float32, e.g. 72.3
+                    -1.0 if np.isnan(kg) else float(str(kg)),
+                    int(reps),
+                )
+
+    def rename(self, hashed_id: str, new_hashed_id: str) -> bool:
+        if os.path.exists(self.path(new_hashed_id)):
+            return super().rename(hashed_id, new_hashed_id)
+        try:
+            os.rename(self.path(hashed_id), self.path(new_hashed_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def hashed_ids(self) -> Iterator[str]:
+        return self.resolver.hashed_ids(".rec")
+
+    def delete_last(self, hashed_id: str) -> bool:
+        try:
+            size = os.path.getsize(self.path(hashed_id))
+        except FileNotFoundError:
+            return False
+        count = size // record_dtype.itemsize
+        if count == 0:
+            return False
+        with open(self.path(hashed_id), "r+b") as file:
+            file.truncate((count - 1) * record_dtype.itemsize)
+        return True
+
+    def delete_all(self, hashed_id: str) -> bool:
+        try:
+            os.remove(self.path(hashed_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+
+def csv_to_records(df: pd.DataFrame, codes: ExerciseCodes) -> np.ndarray:
+    """Encode a history read from a CSV file into columnar records."""
+    records = np.empty(len(df), dtype=record_dtype)
+    records["timestamp"] = df["timestamp"].astype("datetime64[s]").astype(np.int64)
+    records["exercise"] = [codes.encode(name) for name in df["exercise"]]
+    records["kg"] = pd.to_numeric(df["kg"], errors="coerce").fillna(-1)
+    records["reps"] = pd.to_numeric(df["reps"], errors="coerce").fillna(0)
+    records["group"] = df["group"].astype(str) == "True"
+    return records
+
+
+def convert_csv_files(
+    outdir: str, codes: ExerciseCodes, resolver: Optional[PathResolver] = None
+) -> List[str]:
+    """Convert every `<hashed_id>.csv` into `<hashed_id>.rec` next to it.
+
+    The record file is written under a temporary name and renamed into place, the CSV files are
+    left untouched. Returns the converted hashed ids.
+    """
+    resolver = resolver or PathResolver(outdir)
+    csv_storage = CsvStorage(outdir, resolver=resolver, codes=codes)
+    storage = ColumnarStorage(outdir, codes, resolver)
+    converted = []
+    for hashed_id in sorted(resolver.hashed_ids(".csv")):
+        records = csv_to_records(csv_storage.read(hashed_id), codes)
+        tmp_path = storage.path(hashed_id) + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(records.tobytes())
+        os.replace(tmp_path, storage.path(hashed_id))
+        converted.append(hashed_id)
+    return converted
+
+
+def main() -> None:
+    """Convert the CSV histories of a data directory to the columnar format."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("outdir", nargs="?", default="logs")
+    args = parser.parse_args()
+
+    config = read_config(args.outdir)
+    codes = get_exercise_codes(config, args.outdir)
+    converted = convert_csv_files(
+        args.outdir, codes, get_path_resolver(config, args.outdir)
+    )
+    print(f"Converted {len(converted)} files.")
+
+
+if __name__ == "__main__":
+    main()
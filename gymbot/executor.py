@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class IOExecutor:
+    """Thread pool for blocking file I/O and pandas work.
+
+    Handlers await run() instead of calling storage or plotting code directly, so the event loop
+    keeps serving other updates while one user's data is read or written.
+    """
+
+    def __init__(self, max_workers: int = 4, name: str = "gymbot-io"):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.pool, functools.partial(func, *args, **kwargs)
+        )
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=True)
+
+
+class LoopMonitor:
+    """Measures how long the event loop was blocked.
+
+    A task sleeps for `interval` seconds at a time; whatever it oversleeps is time in which the
+    loop could not run anything else. Blocks longer than `warn_threshold` seconds are logged.
+    """
+
+    def __init__(self, interval: float = 0.5, warn_threshold: float = 0.1):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.samples = 0
+        self.blocked_total = 0.0
+        self.blocked_max = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        logger.warning(f"Event loop blocked: {self.stats()}")
+
+    def record(self, blocked: float) -> None:
+        self.samples += 1
+        self.blocked_total += blocked
+        self.blocked_max = max(self.blocked_max, blocked)
+        if blocked > self.warn_threshold:
+            logger.warning(f"Event loop was blocked for {blocked:.3f} s")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "samples": self.samples,
+            "blocked_total": round(self.blocked_total, 3),
+            "blocked_max": round(self.blocked_max, 3),
+        }
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, loop.time() - start - self.interval))
@@ -0,0 +1,114 @@
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+kinds = ["weighted", "bodyweight"]
+
+plot_metrics = ["kg", "reps"]
+
+# the settings earlier versions had built in, `exercise_settings` in env.json overrides them
+default_settings: Dict[str, Dict[str, Any]] = {
+    **{
+        name: {"kg": [5, 40, 1]}
+        for name in [
+            "Walking Lunges",
+            "Dumbbell Rows",
+            "Shoulder Press",
+            "Biceps Curl",
+            "Triceps Extension",
+        ]
+    },
+    **{
+        name: {"kind": "bodyweight"}
+        for name in [
+            "Pullup overhand",
+            "Pullup underhand",
+            "Pushup",
+            "The Countdown",
+            "Hanging Leg Raise",
+        ]
+    },
+}
+
+
+class Exercise(NamedTuple):
+    name: str
+    kind: str = "weighted"
+    # the kg offered on the keyboard, from kg_min to kg_max in steps of kg_step
+    kg_min: float = 20
+    kg_max: float = 200
+    kg_step: float = 5
+    # what the report plots over time
+    plot: str = "kg"
+
+    @property
+    def bodyweight(self) -> bool:
+        return self.kind == "bodyweight"
+
+    def kg_values(self) -> Optional[List[str]]:
+        """The kg offered for the exercise as they are stored, None for bodyweight exercises."""
+        if self.bodyweight:
+            return None
+        count = int(round((self.kg_max - self.kg_min) / self.kg_step)) + 1
+        return [f"{round(self.kg_min + i * self.kg_step, 6):g}" for i in range(count)]
+
+
+def valid_kg(kg: Any) -> bool:
+    if not isinstance(kg, list) or len(kg) != 3:
+        return False
+    if not all(isinstance(value, (int, float)) for value in kg):
+        return False
+    return 0 <= kg[0] <= kg[1] and kg[2] > 0 and (kg[1] - kg[0]) / kg[2] <= 100
+
+
+def make_exercise(name: str, settings: Dict[str, Any]) -> Exercise:
+    """The exercise with settings like {"kind": "weighted", "kg": [min, max, step], "plot": "kg"}.
+
+    Raises ValueError if a setting is invalid.
+    """
+    kind = settings.get("kind", "weighted")
+    if kind not in kinds:
+        raise ValueError(
+            f"{name}: kind must be one of {', '.join(kinds)}, not {kind!r}"
+        )
+    plot = settings.get("plot", "reps" if kind == "bodyweight" else "kg")
+    if plot not in plot_metrics or (kind == "bodyweight" and plot == "kg"):
+        raise ValueError(f"{name}: can't plot {plot!r} of a {kind} exercise")
+    kg = settings.get("kg", [20, 200, 5])
+    if not valid_kg(kg):
+        raise ValueError(
+            f"{name}: kg must be [min, max, step] with at most 100 steps, not {kg!r}"
+        )
+    return Exercise(name, kind, kg[0], kg[1], kg[2], plot)
+
+
+class ExerciseRegistry:
+    """The configured exercises in order and their settings, looked up by name.
+
+    Exercises that are no longer configured, e.g. in old histories or keyboards, get their
+    default settings.
+    """
+
+    def __init__(
+        self, names: Sequence[str], settings: Optional[Dict[str, Dict[str, Any]]] = None
+    ):
+        settings = settings or {}
+        self.names = list(names)
+        self.exercises: Dict[str, Exercise] = {
+            name: make_exercise(
+                name, {**default_settings.get(name, {}), **settings.get(name, {})}
+            )
+            for name in self.names
+        }
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.exercises
+
+    def get(self, name: str) -> Exercise:
+        exercise = self.exercises.get(name)
+        if exercise is None:
+            exercise = make_exercise(name, default_settings.get(name, {}))
+        return exercise
+
+
+def get_exercise_registry(config: Dict) -> ExerciseRegistry:
+    """The registry of `exercises` and the optional `exercise_settings` of env.json."""
+    return ExerciseRegistry(config["exercises"], config.get("exercise_settings"))
@@ -0,0 +1,63 @@
+import csv
+import gzip
+import io
+import json
+import math
+from typing import IO, Any, Iterable, Tuple
+
+from gymbot.storage import Row, Storage, df_columns
+
+export_formats = ["csv", "jsonl"]
+
+# imported uploads are kept in memory up to this size and spill over into a temporary file beyond it
+spool_bytes = 1 << 20
+
+
+def export_kg(kg: Any) -> str:
+    """kg as the importer reads it back, -1 for bodyweight sets.
+
+    Older versions stored the exercise name as the kg of bodyweight sets and some engines return
+    them as NaN.
+    """
+    try:
+        value = float(kg)
+    except (TypeError, ValueError):
+        return "-1"
+    return f"{value:g}" if math.isfinite(value) else "-1"
+
+
+def write_rows(rows: Iterable[Row], file: IO[str], export_format: str = "csv") -> int:
+    """Write rows as CSV with a header or as JSON Lines, returns how many were written."""
+    count = 0
+    if export_format == "csv":
+        writer = csv.writer(file)
+        writer.writerow(df_columns)
+    for group, timestamp, exercise, kg, reps in rows:
+        timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        kg = export_kg(kg)
+        if export_format == "csv":
+            writer.writerow([group, timestamp, exercise, kg, reps])
+        else:
+            entry = dict(zip(df_columns, [group, timestamp, exercise, kg, reps]))
+            file.write(json.dumps(entry) + "\n")
+        count += 1
+    return count
+
+
+def export_filename(export_format: str) -> str:
+    return f"gymbot-history.{export_format}.gz"
+
+
+def export_history(
+    storage: Storage, hashed_id: str, export_format: str = "csv"
+) -> Tuple[bytes, int]:
+    """Stream a user's history into a gzip compressed export, returns its bytes and the row count.
+
+    Rows are read with iter_rows() and compressed as they are written, so only the compressed export
+    is held in memory, which is how the bot library uploads documents anyway.
+    """
+    buffer = io.BytesIO()
+    # closing the gzip stream finishes it but leaves the buffer open
+    with gzip.open(buffer, "wt", encoding="utf-8", newline="") as text:
+        count = write_rows(storage.iter_rows(hashed_id), text, export_format)
+    return buffer.getvalue(), count
@@ -0,0 +1,211 @@
+import csv
+import gzip
+import io
+import itertools
+import json
+import math
+from datetime import datetime
+from typing import IO, Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from gymbot.exercises import ExerciseRegistry
+from gymbot.storage import Row
+
+# uploads of an /export start with the gzip magic number
+gzip_magic = b"\x1f\x8b"
+
+timestamp_formats = ["%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y"]
+
+required_columns = ["timestamp", "exercise", "kg", "reps"]
+
+# other names spreadsheets use for the columns
+column_aliases = {"date": "timestamp", "time": "timestamp", "weight": "kg"}
+
+
+class RowError(NamedTuple):
+    """A row of an upload that could not be imported, lines are numbered from 1 like in editors."""
+
+    line: int
+    message: str
+
+
+class ImportResult(NamedTuple):
+    # the valid rows, sorted by timestamp
+    rows: List[Row]
+    # the first max_errors errors
+    errors: List[RowError]
+    error_count: int
+
+
+def open_upload(file: IO[bytes]) -> IO[str]:
+    """Text stream of an uploaded document, gzip compressed or not."""
+    compressed = file.read(2) == gzip_magic
+    file.seek(0)
+    if compressed:
+        return gzip.open(file, "rt", encoding="utf-8-sig", newline="")
+    return io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+
+
+def column_name(name: Any) -> str:
+    name = str(name).strip().lower()
+    return column_aliases.get(name, name)
+
+
+def iter_records(text: IO[str]) -> Iterator[Tuple[int, Optional[Dict[str, Any]], str]]:
+    """Yield the line, the fields and an error message per row of JSON Lines or a CSV with header."""
+    first = text.readline()
+    if first.lstrip().startswith("{"):
+        for line, content in enumerate(itertools.chain([first], text), 1):
+            if not content.strip():
+                continue
+            try:
+                fields = json.loads(content)
+            except ValueError as e:
+                yield line, None, f"invalid JSON ({e})"
+                continue
+            if not isinstance(fields, dict):
+                yield line, None, "not a JSON object"
+                continue
+            yield line, {column_name(k): v for k, v in fields.items()}, ""
+        return
+
+    header = [column_name(name) for name in next(csv.reader([first]), [])]
+    missing = [name for name in required_columns if name not in header]
+    if missing:
+        yield 1, None, f"missing columns: {', '.join(missing)}"
+        return
+    for line, values in enumerate(csv.reader(text), 2):
+        if not any(value.strip() for value in values):
+            continue
+        if len(values) != len(header):
+            yield line, None, f"expected {len(header)} columns, got {len(values)}"
+            continue
+        yield line, dict(zip(header, values)), ""
+
+
+def exercise_key(name: str) -> str:
+    return " ".join(name.lower().split())
+
+
+def parse_timestamp(value: Any, now: datetime) -> datetime:
+    value = str(value).strip()
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        for timestamp_format in timestamp_formats:
+            try:
+                timestamp = datetime.strptime(value, timestamp_format)
+                break
+            except ValueError:
+                pass
+        else:
+            raise ValueError(f"unknown timestamp {value!r}, use e.g. 2023-01-31 18:30")
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    if timestamp > now:
+        raise ValueError(f"timestamp {value} is in the future")
+    return timestamp.replace(microsecond=0)
+
+
+def parse_kg(value: Any, bodyweight: bool = False) -> str:
+    """kg as stored by the bot, -1 for bodyweight exercises.
+
+    Older versions stored the exercise name as the kg of bodyweight sets, for bodyweight exercises
+    anything that is not a number is taken as -1.
+    """
+    if value is None or str(value).strip() in ["", "-1"]:
+        return "-1"
+    try:
+        kg = float(str(value).strip().replace(",", "."))
+    except ValueError:
+        if bodyweight:
+            return "-1"
+        raise ValueError(f"kg {value!r} is not a number")
+    if bodyweight and math.isnan(kg):
+        return "-1"
+    if not 0 <= kg <= 1000:
+        raise ValueError(f"kg {value} is out of range")
+    return f"{kg:g}"
+
+
+def parse_reps(value: Any) -> str:
+    try:
+        reps = float(str(value).strip())
+    except ValueError:
+        raise ValueError(f"reps {value!r} is not a number")
+    if not reps.is_integer() or not 1 <= reps <= 1000:
+        raise ValueError(f"reps {value} is not a whole number from 1 to 1000")
+    return str(int(reps))
+
+
+def parse_group(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    value = "" if value is None else str(value).strip().lower()
+    if value in ["", "0", "false", "no"]:
+        return False
+    if value in ["1", "true", "yes"]:
+        return True
+    raise ValueError(f"group {value!r} is not true or false")
+
+
+def normalize(
+    fields: Dict[str, Any],
+    exercises: Dict[str, str],
+    registry: ExerciseRegistry,
+    now: datetime,
+) -> Row:
+    """The row of the fields of an upload, raises ValueError if they are invalid."""
+    for name in required_columns:
+        if name not in fields:
+            raise ValueError(f"{name} is missing")
+    exercise = exercises.get(exercise_key(str(fields["exercise"])))
+    if exercise is None:
+        raise ValueError(f"unknown exercise {fields['exercise']!r}")
+    return (
+        parse_group(fields.get("group")),
+        parse_timestamp(fields["timestamp"], now),
+        exercise,
+        parse_kg(fields["kg"], registry.get(exercise).bodyweight),
+        parse_reps(fields["reps"]),
+    )
+
+
+def parse_upload(
+    file: IO[bytes],
+    registry: ExerciseRegistry,
+    max_rows: int = 100000,
+    max_errors: int = 20,
+) -> ImportResult:
+    """Validate and normalize an uploaded CSV or JSON Lines document row by row.
+
+    Exercise names are matched against the configured exercises ignoring case and whitespace.
+    Only the normalized rows are kept, the upload itself is streamed and never held in memory.
+    """
+    known = {exercise_key(name): name for name in registry.names}
+    now = datetime.now()
+    rows: List[Row] = []
+    errors: List[RowError] = []
+    error_count = 0
+    for line, fields, error in iter_records(open_upload(file)):
+        if fields is not None:
+            try:
+                rows.append(normalize(fields, known, registry, now))
+            except ValueError as e:
+                error = str(e)
+        if error:
+            error_count += 1
+            if len(errors) < max_errors:
+                errors.append(RowError(line, error))
+        if len(rows) > max_rows:
+            errors.append(RowError(line, f"more than {max_rows} rows"))
+            error_count += 1
+            break
+    rows.sort(key=lambda row: row[1])
+    return ImportResult(rows, errors, error_count)
+
+
+def format_errors(result: ImportResult) -> str:
+    lines = [f"Line {error.line}: {error.message}" for error in result.errors]
+    if result.error_count > len(result.errors):
+        lines.append(f"... and {result.error_count - len(result.errors)} more")
+    return "\n".join(lines)
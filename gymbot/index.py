@@ -0,0 +1,111 @@
+import calendar
+import sqlite3
+import threading
+import time
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+
+class UserStats(NamedTuple):
+    rows: int
+    # epoch seconds of the last append
+    last_write: int
+
+
+class UserIndex:
+    """Persistent index of the users with a history, their row counts and last write times.
+
+    Kept in a small SQLite database next to the histories, so checking whether a user has any data
+    is a primary key lookup instead of opening their file. The index starts out incomplete and only
+    answers for users it knows until every existing history was counted into it with count_rows()
+    and mark_built() was called.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "user TEXT PRIMARY KEY, "
+                "rows INTEGER NOT NULL, "
+                "last_write INTEGER NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)"
+            )
+        self.built = self._meta("built") == 1
+
+    def _meta(self, key: str):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def get(self, hashed_id: str) -> Optional[UserStats]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT rows, last_write FROM users WHERE user = ?", (hashed_id,)
+            ).fetchone()
+        return None if row is None else UserStats(*row)
+
+    def is_empty(self, hashed_id: str) -> bool:
+        """Whether the user surely has no history, False if the index can't tell yet."""
+        return self.built and self.get(hashed_id) is None
+
+    def added(self, hashed_id: str, rows: int) -> None:
+        if rows == 0:
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO users (user, rows, last_write) VALUES (?, ?, ?) "
+                "ON CONFLICT (user) DO UPDATE SET rows = rows + excluded.rows, last_write = excluded.last_write",
+                (hashed_id, rows, int(time.time())),
+            )
+
+    def deleted_last(self, hashed_id: str) -> None:
+        with self.lock, self.connection:
+            # the user stays known, only deleting everything forgets them
+            self.connection.execute(
+                "UPDATE users SET rows = MAX(rows - 1, 0) WHERE user = ?", (hashed_id,)
+            )
+
+    def deleted_all(self, hashed_id: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM users WHERE user = ?", (hashed_id,))
+
+    def count_rows(self, hashed_id: str, rows: Iterable[Tuple]) -> None:
+        """Index a user by counting their stored rows, the newest timestamp stands in for the last
+        write. The caller has to keep the history from changing meanwhile."""
+        count = 0
+        last_write = 0
+        for row in rows:
+            count += 1
+            last_write = max(last_write, calendar.timegm(row[1].timetuple()))
+        self.set_user(hashed_id, count, last_write)
+
+    def set_user(self, hashed_id: str, rows: int, last_write: int) -> None:
+        with self.lock, self.connection:
+            if rows == 0:
+                self.connection.execute(
+                    "DELETE FROM users WHERE user = ?", (hashed_id,)
+                )
+            else:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO users (user, rows, last_write) VALUES (?, ?, ?)",
+                    (hashed_id, rows, last_write),
+                )
+
+    def mark_built(self) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('built', 1)"
+            )
+        self.built = True
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
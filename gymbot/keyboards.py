@@ -0,0 +1,103 @@
+import functools
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from gymbot.callbacks import Selection, encode_selection, sets_range
+from gymbot.codes import ExerciseCodes
+from gymbot.exercises import ExerciseRegistry
+
+reps_range = range(1, 51)
+
+# callback data of the button repeating the last set
+again_data = "again"
+
+
+def build_markup(
+    buttons: Sequence[Tuple[str, str]], chunk_size: int
+) -> InlineKeyboardMarkup:
+    """Keyboard of (text, callback data) buttons, `chunk_size` per row."""
+    keyboard = [
+        InlineKeyboardButton(text, callback_data=data) for text, data in buttons
+    ]
+    chunks = [keyboard[x : x + chunk_size] for x in range(0, len(keyboard), chunk_size)]
+    return InlineKeyboardMarkup(chunks)
+
+
+class Keyboards:
+    """The inline keyboards of the bot, built once and shared by all users.
+
+    Telegram objects can't be changed after they were created, so handlers can send the same
+    instances concurrently. The exercise and kg keyboards are built for all configured exercises
+    up front, the reps keyboards depend on the selected kg and sets and are built on first use and
+    kept for the `cache_size` most recently used selections. Build a new instance when the
+    exercises change.
+    """
+
+    def __init__(
+        self,
+        registry: ExerciseRegistry,
+        codes: ExerciseCodes,
+        cache_size: int = 1024,
+    ):
+        self.registry = registry
+        self.codes = codes
+        self.exercises = build_markup(
+            [
+                (name, encode_selection(Selection(codes.encode(name))))
+                for name in registry.names
+            ],
+            2,
+        )
+        self.kg_markups: Dict[int, Optional[InlineKeyboardMarkup]] = {
+            codes.encode(name): self._kg(Selection(codes.encode(name)))
+            for name in registry.names
+        }
+        self.clear_all = build_markup([("Yes", "Yes"), ("No", "No")], 2)
+        self.again = build_markup([("Same again", again_data)], 1)
+        self.reps_values = {str(d) for d in reps_range}
+        self.reps = functools.lru_cache(maxsize=cache_size)(self._reps)
+
+    def offers(
+        self, exercise: str, kg: Union[str, int], reps: str, sets: int = 1
+    ) -> bool:
+        """Whether the keyboards offer the kg, reps and sets logged, callback data can be forged."""
+        kgs = self.registry.get(exercise).kg_values()
+        if kgs is None:
+            valid_kg = str(kg) == "-1"
+        else:
+            valid_kg = str(kg) in kgs
+        return valid_kg and reps in self.reps_values and sets in sets_range
+
+    def _kg(self, selection: Selection) -> Optional[InlineKeyboardMarkup]:
+        kgs = self.registry.get(self.codes.decode(selection.code)).kg_values()
+        if kgs is None:
+            return None
+        return build_markup(
+            [(kg, encode_selection(selection._replace(kg=kg))) for kg in kgs], 5
+        )
+
+    def kg(self, selection: Selection) -> Optional[InlineKeyboardMarkup]:
+        """The kg keyboard of the selected exercise, None for bodyweight exercises."""
+        if selection.code in self.kg_markups:
+            return self.kg_markups[selection.code]
+        # exercises removed from the config since the keyboard was sent
+        return self._kg(selection)
+
+    def _reps(self, selection: Selection) -> InlineKeyboardMarkup:
+        """The reps keyboard, its first row chooses how many identical sets are logged, ×1 to ×5."""
+        sets = [
+            InlineKeyboardButton(
+                f"✓ ×{n}" if n == selection.sets else f"×{n}",
+                callback_data=encode_selection(selection._replace(sets=n)),
+            )
+            for n in sets_range
+        ]
+        reps = build_markup(
+            [
+                (str(d), encode_selection(selection._replace(reps=str(d))))
+                for d in reps_range
+            ],
+            5,
+        )
+        return InlineKeyboardMarkup([sets, *reps.inline_keyboard])
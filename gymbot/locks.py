@@ -0,0 +1,122 @@
+import asyncio
+import contextlib
+import os
+import threading
+from typing import Any, AsyncIterator, Awaitable, Dict, Hashable, Iterator, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+class UserLocks:
+    """One asyncio lock per key, e.g. per hashed id.
+
+    Locks are created on first use and dropped again once nobody holds or waits for them, so the
+    number of locks is bounded by the number of users active at the same time.
+    """
+
+    def __init__(self):
+        self.locks: Dict[Hashable, asyncio.Lock] = {}
+        self.users: Dict[Hashable, int] = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+            self.users[key] = 0
+        self.users[key] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.users[key] -= 1
+            if self.users[key] == 0:
+                del self.users[key]
+                del self.locks[key]
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different users concurrently but the updates of one user in order.
+
+    Conversation states and the in-progress selections are per user, so keeping each user's
+    updates sequential lets the ConversationHandler work as with sequential processing.
+
+    The base class holds its semaphore while an update waits for the user's lock, so a user sending
+    many updates at once could take every slot. It gets a limit that is never reached instead, and
+    `max_concurrent_updates` is applied by a semaphore taken after the user's lock.
+    """
+
+    __slots__ = ("user_locks", "limit", "semaphore")
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(1 << 30)
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        self.user_locks = UserLocks()
+        self.limit = max_concurrent_updates
+        self.semaphore: Optional[asyncio.BoundedSemaphore] = None
+
+    async def do_process_update(
+        self, update: object, coroutine: Awaitable[Any]
+    ) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self.semaphore:
+                await coroutine
+            return
+        async with self.user_locks.hold(user.id), self.semaphore:
+            await coroutine
+
+    async def initialize(self) -> None:
+        # created in the running event loop
+        self.semaphore = asyncio.BoundedSemaphore(self.limit)
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class FileLocks:
+    """Exclusive inter-process locks per hashed id for multi-process deployments.
+
+    Uses fcntl.flock on a fixed set of `stripes` lock files in `lock_dir`, picked by the hashed id's
+    prefix, so the number of lock files does not grow with the number of users. A thread lock per
+    stripe keeps threads of the same process from sharing one flock.
+    """
+
+    def __init__(self, lock_dir: str, stripes: int = 256):
+        if fcntl is None:
+            raise RuntimeError("File locks need fcntl, which is not available here")
+        os.makedirs(lock_dir, exist_ok=True)
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self.thread_locks = [threading.Lock() for _ in range(stripes)]
+
+    def stripe(self, hashed_id: str) -> int:
+        return int(hashed_id[:8], 16) % self.stripes
+
+    @contextlib.contextmanager
+    def hold(self, hashed_id: str) -> Iterator[None]:
+        stripe = self.stripe(hashed_id)
+        with self.thread_locks[stripe]:
+            with flock(os.path.join(self.lock_dir, f"{stripe:03}.lock")):
+                yield
+
+
+@contextlib.contextmanager
+def flock(path: str) -> Iterator[None]:
+    """Hold an exclusive fcntl lock on the file at path, a no-op where fcntl is missing."""
+    with open(path, "a") as file:
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
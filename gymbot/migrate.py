@@ -0,0 +1,307 @@
+import argparse
+import contextlib
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+from typing import ContextManager, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from gymbot.locks import FileLocks
+from gymbot.paths import get_path_resolver
+from gymbot.storage import Row, Storage, get_engine, to_epoch, truncate_file
+from gymbot.tools import read_config
+
+logger = logging.getLogger(__name__)
+
+# state of a worker process, set up once by init_worker
+source: Optional[Storage] = None
+target: Optional[Storage] = None
+file_locks: Optional[FileLocks] = None
+rows_per_second = 0.0
+batch_size = 1000
+
+
+def canonical_row(row: Row) -> str:
+    """A row formatted the same way whichever engine it was read from.
+
+    Engines differ in how they return kg and reps (strings from CSV, numbers from SQLite, float32
+    from columnar files), so kg is rounded to what float32 can hold and bodyweight kg become -1,
+    also the ones older versions stored as the exercise name.
+    """
+    group, timestamp, exercise, kg, reps = row
+    try:
+        kg = float(kg)
+    except (TypeError, ValueError):
+        kg = -1.0
+    kg = "-1" if math.isnan(kg) else format(kg, ".6g")
+    try:
+        reps = int(float(reps))
+    except (TypeError, ValueError):
+        reps = 0
+    return f"{bool(group)},{to_epoch(timestamp)},{exercise},{kg},{reps}\n"
+
+
+def summarize(rows: Iterable[Row]) -> Tuple[int, str]:
+    """Row count and checksum of a history."""
+    checksum = hashlib.sha256()
+    count = 0
+    for row in rows:
+        checksum.update(canonical_row(row).encode())
+        count += 1
+    return count, checksum.hexdigest()
+
+
+def batches(rows: Iterator[Row], size: int) -> Iterator[List[Row]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def engine_config(config: Dict, engine: str) -> Dict:
+    """The config of one engine, writing directly and without a history cache."""
+    return {
+        **config,
+        "storage": engine,
+        "buffered_writes": False,
+        "history_cache_mb": 0,
+    }
+
+
+def init_worker(
+    config: Dict, outdir: str, source_engine: str, target_engine: str, rate: float
+) -> None:
+    global source, target, file_locks, rows_per_second
+    # leave the CPU to the live bot
+    os.nice(10)
+    resolver = get_path_resolver(config, outdir)
+    source = get_engine(engine_config(config, source_engine), outdir, resolver)
+    target = get_engine(engine_config(config, target_engine), outdir, resolver)
+    if config.get("file_locks", False):
+        file_locks = FileLocks(os.path.join(outdir, "locks"))
+    rows_per_second = rate
+
+
+def hold(hashed_id: str) -> ContextManager:
+    if file_locks is None:
+        return contextlib.nullcontext()
+    return file_locks.hold(hashed_id)
+
+
+def migrate_user(hashed_id: str) -> Tuple[str, int, str, Optional[str]]:
+    """Copy the history of a user to the target engine and verify it.
+
+    Returns the hashed id, the row count, the checksum and an error message if it failed.
+    """
+    try:
+        with hold(hashed_id):
+            # left over from an interrupted run
+            target.delete_all(hashed_id)
+            checksum = hashlib.sha256()
+            count = 0
+            started = time.monotonic()
+            for batch in batches(source.iter_rows(hashed_id), batch_size):
+                target.append(hashed_id, batch)
+                for row in batch:
+                    checksum.update(canonical_row(row).encode())
+                count += len(batch)
+                if rows_per_second > 0:
+                    # sleep until the rows written so far are within the rate
+                    time.sleep(
+                        max(0.0, count / rows_per_second - (time.monotonic() - started))
+                    )
+
+            expected = count, checksum.hexdigest()
+            copied = summarize(target.iter_rows(hashed_id))
+    except Exception as e:
+        return hashed_id, 0, "", repr(e)
+    if copied != expected:
+        return (
+            hashed_id,
+            copied[0],
+            copied[1],
+            f"expected {expected[0]} rows with checksum {expected[1]}",
+        )
+    return hashed_id, count, expected[1], None
+
+
+def check_user(hashed_id: str) -> Tuple[str, int, str, Optional[str]]:
+    """The row count and checksum of a user's history in the source engine, to find the users
+    written to since they were migrated. Returns an error message instead if it failed.
+    """
+    try:
+        with hold(hashed_id):
+            count, checksum = summarize(source.iter_rows(hashed_id))
+    except Exception as e:
+        return hashed_id, 0, "", repr(e)
+    return hashed_id, count, checksum, None
+
+
+def read_journal(path: str) -> Dict[str, Tuple[int, str]]:
+    """Row count and checksum of the users migrated and verified by previous runs, by hashed id."""
+    done = {}
+    try:
+        with open(path) as file:
+            for line in file:
+                if not line.endswith("\n"):
+                    continue
+                hashed_id, count, checksum = line.rstrip("\n").split("\t")
+                # users copied again later have another line
+                done[hashed_id] = int(count), checksum
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def repair_journal(path: str) -> None:
+    """Cut off the partial last line of an interrupted run, so the next line is appended after it."""
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        return
+    if data and not data.endswith(b"\n"):
+        truncate_file(path, data.rfind(b"\n") + 1)
+
+
+def source_ids(config: Dict, outdir: str, source_engine: str) -> Set[str]:
+    source = get_engine(
+        engine_config(config, source_engine),
+        outdir,
+        get_path_resolver(config, outdir),
+    )
+    try:
+        return set(source.hashed_ids())
+    finally:
+        source.close()
+
+
+def migrate(
+    config: Dict,
+    outdir: str,
+    source_engine: str,
+    target_engine: str,
+    journal_path: str,
+    workers: int = 2,
+    rate: float = 0.0,
+    catch_up: int = 1,
+) -> Tuple[int, List[str]]:
+    """Migrate every user not in the journal yet, returns how many were migrated and the failed ones.
+
+    Users are streamed through a pool of worker processes with batched appends, so memory use does
+    not depend on the size of the histories. Each verified user is added to the journal with its
+    row count and checksum right away, an interrupted migration continues where it stopped when it
+    is run again. The rate in rows per second is shared by the workers.
+
+    The bot may log sets while users are migrated, so up to `catch_up` passes then compare every
+    journaled user with the source and copy the ones that changed again, until a pass finds none.
+    Sets logged after the last pass are only copied by running the migration again.
+    """
+    repair_journal(journal_path)
+    done = read_journal(journal_path)
+    pending = sorted(source_ids(config, outdir, source_engine) - set(done))
+    logger.warning(
+        f"Migrating {len(pending)} users from {source_engine} to {target_engine}, {len(done)} done"
+    )
+
+    migrated = 0
+    failed = []
+    init_args = (config, outdir, source_engine, target_engine, rate / workers)
+    with multiprocessing.Pool(workers, init_worker, init_args) as pool, open(
+        journal_path, "a"
+    ) as journal:
+        for catch_up_pass in range(catch_up + 1):
+            if catch_up_pass > 0:
+                # users first logged meanwhile, and changed or deleted ones, whose copies are emptied
+                pending = sorted(
+                    source_ids(config, outdir, source_engine) - set(done) - set(failed)
+                )
+                for hashed_id, count, checksum, error in pool.imap_unordered(
+                    check_user, sorted(set(done) - set(failed))
+                ):
+                    if error is not None:
+                        logger.error(f"Checking {hashed_id} failed: {error}")
+                        failed.append(hashed_id)
+                    elif (count, checksum) != done[hashed_id]:
+                        pending.append(hashed_id)
+                if not pending:
+                    break
+                logger.warning(
+                    f"Catch-up pass {catch_up_pass}: migrating {len(pending)} new or changed users"
+                )
+            for hashed_id, count, checksum, error in pool.imap_unordered(
+                migrate_user, pending
+            ):
+                if error is not None:
+                    logger.error(f"Migrating {hashed_id} failed: {error}")
+                    failed.append(hashed_id)
+                    continue
+                journal.write(f"{hashed_id}\t{count}\t{checksum}\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+                done[hashed_id] = count, checksum
+                migrated += 1
+    return migrated, failed
+
+
+def main() -> None:
+    """Copy the histories of a data directory from one storage engine to another."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("outdir", nargs="?", default="logs")
+    parser.add_argument(
+        "--source", help="engine to copy from, by default the configured one"
+    )
+    parser.add_argument(
+        "--target", required=True, choices=["csv", "sqlite", "columnar"]
+    )
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument(
+        "--rows-per-second",
+        type=float,
+        default=0.0,
+        help="write rate limit, 0 for none",
+    )
+    parser.add_argument(
+        "--catch-up",
+        type=int,
+        default=1,
+        help="passes copying the users changed meanwhile again, 0 for none",
+    )
+    parser.add_argument(
+        "--journal",
+        help="progress journal, by default migrate-<source>-<target>.journal",
+    )
+    args = parser.parse_args()
+
+    config = read_config(args.outdir)
+    source_engine = args.source or config.get("storage", "csv")
+    if source_engine == args.target:
+        parser.error("source and target engine are the same")
+    journal_path = args.journal or os.path.join(
+        args.outdir, f"migrate-{source_engine}-{args.target}.journal"
+    )
+
+    migrated, failed = migrate(
+        config,
+        args.outdir,
+        source_engine,
+        args.target,
+        journal_path,
+        args.workers,
+        args.rows_per_second,
+        args.catch_up,
+    )
+    print(f"Migrated {migrated} users, {len(failed)} failed.")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
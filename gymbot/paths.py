@@ -0,0 +1,116 @@
+import logging
+import os
+from typing import Dict, Iterator, Sequence
+
+logger = logging.getLogger(__name__)
+
+# suffixes of the files kept per user by the storage engines
+user_file_suffixes = [".csv", ".rec", ".csv.gz", ".csv.rolling", ".segments.json"]
+
+
+class PathResolver:
+    """Maps hashed ids to the paths of their files in the data directory.
+
+    With `levels` > 0 files are sharded by the prefix of the hashed id, e.g. with 2 levels of
+    `width` 2 the history of `abcdef...` is `<outdir>/ab/cd/abcdef....csv`, which keeps directories
+    small with many users. Files still in the flat layout are moved into their shard the first
+    time they are resolved, and migrate_flat_files() moves the rest while the bot is running.
+    """
+
+    def __init__(self, outdir: str, levels: int = 0, width: int = 2):
+        self.outdir = outdir
+        self.levels = levels
+        self.width = width
+        # cleared once no flat files are left, so resolving doesn't need to look for them
+        self.flat_files_left = levels > 0
+
+    def directory(self, hashed_id: str) -> str:
+        shards = [
+            hashed_id[level * self.width : (level + 1) * self.width]
+            for level in range(self.levels)
+        ]
+        return os.path.join(self.outdir, *shards)
+
+    def flat_path(self, hashed_id: str, suffix: str) -> str:
+        return os.path.join(self.outdir, f"{hashed_id}{suffix}")
+
+    def path(self, hashed_id: str, suffix: str) -> str:
+        """Path of a user's file, e.g. with suffix `.csv`; its directory is created if missing."""
+        if self.levels == 0:
+            return self.flat_path(hashed_id, suffix)
+
+        directory = self.directory(hashed_id)
+        path = os.path.join(directory, f"{hashed_id}{suffix}")
+        if self.flat_files_left and not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            move_no_clobber(self.flat_path(hashed_id, suffix), path)
+        elif not self.flat_files_left:
+            os.makedirs(directory, exist_ok=True)
+        return path
+
+    def hashed_ids(self, suffix: str) -> Iterator[str]:
+        """All hashed ids with a file with suffix, in the flat and the sharded layout."""
+        for root, directories, files in os.walk(self.outdir):
+            relative = os.path.relpath(root, self.outdir)
+            depth = 0 if relative == "." else relative.count(os.sep) + 1
+            if depth >= self.levels:
+                directories.clear()
+            for name in files:
+                if name.endswith(suffix) and (depth == 0 or depth == self.levels):
+                    yield name[: -len(suffix)]
+
+    def migrate_flat_files(self, suffixes: Sequence[str]) -> int:
+        """Move every flat file with one of suffixes into its shard, returns how many were moved."""
+        if self.levels == 0:
+            return 0
+        moved = 0
+        for name in os.listdir(self.outdir):
+            for suffix in suffixes:
+                if name.endswith(suffix) and os.path.isfile(
+                    os.path.join(self.outdir, name)
+                ):
+                    # resolving the path moves the file
+                    self.path(name[: -len(suffix)], suffix)
+                    moved += 1
+        self.flat_files_left = False
+        logger.warning(f"Moved {moved} files into the sharded layout")
+        return moved
+
+
+def move_no_clobber(source: str, destination: str) -> bool:
+    """Move source to destination unless destination exists, returns whether it was moved.
+
+    A hard link fails if the destination exists, so a file created concurrently at the destination
+    is never overwritten. Open handles of the source keep writing to the moved file.
+    """
+    try:
+        os.link(source, destination)
+    except FileNotFoundError:
+        return False
+    except FileExistsError:
+        try:
+            # another thread may be moving the same file right now
+            moved_concurrently = os.path.samefile(source, destination)
+        except FileNotFoundError:
+            moved_concurrently = True
+        if not moved_concurrently:
+            logger.error(f"Not moving {source}, {destination} already exists")
+        return False
+    except OSError:
+        # no hard links on this filesystem
+        if os.path.exists(destination):
+            return False
+        os.rename(source, destination)
+        return True
+    try:
+        os.remove(source)
+    except FileNotFoundError:
+        pass
+    return True
+
+
+def get_path_resolver(config: Dict, outdir: str) -> PathResolver:
+    """Resolver for the layout set by `shard_levels` and `shard_width` in env.json."""
+    return PathResolver(
+        outdir, config.get("shard_levels", 0), config.get("shard_width", 2)
+    )
@@ -0,0 +1,236 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Any, Dict, Optional, Sequence, Set, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from gymbot.sessions import MemorySessionStore
+
+# conversation states by conversation key, as ConversationHandler keeps them
+ConversationDict = Dict[Tuple[int, ...], object]
+
+
+class SqlitePersistence(BasePersistence):
+    """Persists the conversation states and in-progress selections in SQLite across restarts.
+
+    The Application hands over changed conversation states every `update_interval` seconds; they
+    are staged and written behind together with the sessions changed since, in one transaction on
+    `executor`. Only conversations in the middle of a flow are kept: states in `resting_states`
+    behave like no conversation at all and are deleted, and so are conversations not updated for
+    `ttl` seconds. Startup only loads these, so it does not get slower with the number of users.
+    User, chat, bot and callback data are not used by the bot and not stored.
+    """
+
+    __slots__ = (
+        "path",
+        "ttl",
+        "resting_states",
+        "sessions",
+        "executor",
+        "lock",
+        "connection",
+        "pending",
+        "write_task",
+    )
+
+    def __init__(
+        self,
+        path: str,
+        sessions: Optional[MemorySessionStore] = None,
+        executor: Optional[Executor] = None,
+        ttl: float = 3600,
+        resting_states: Sequence[object] = (),
+        update_interval: float = 5,
+    ):
+        super().__init__(
+            PersistenceInput(
+                bot_data=False, chat_data=False, user_data=False, callback_data=False
+            ),
+            update_interval,
+        )
+        self.path = path
+        self.ttl = ttl
+        self.resting_states = set(resting_states)
+        self.sessions = sessions
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "name TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "state TEXT NOT NULL, "
+                "updated REAL NOT NULL, "
+                "PRIMARY KEY (name, key))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "key TEXT PRIMARY KEY, "
+                "data TEXT NOT NULL, "
+                "expires REAL NOT NULL)"
+            )
+        self.pending: Dict[Tuple[str, str], Optional[object]] = {}
+        self.write_task: Optional[asyncio.Task] = None
+        if sessions is not None:
+            self._restore_sessions()
+            sessions.track_changes()
+
+    def _restore_sessions(self) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM sessions WHERE expires <= ?", (time.time(),)
+            )
+            rows = self.connection.execute(
+                "SELECT key, data, expires FROM sessions ORDER BY expires"
+            ).fetchall()
+        for key, data, expires in rows:
+            self.sessions.restore(key, expires, json.loads(data))
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._load_conversations, name
+        )
+
+    def _load_conversations(self, name: str) -> ConversationDict:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM conversations WHERE updated <= ?",
+                (time.time() - self.ttl,),
+            )
+            rows = self.connection.execute(
+                "SELECT key, state FROM conversations WHERE name = ?", (name,)
+            ).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(
+        self, name: str, key: Tuple[int, ...], new_state: Optional[object]
+    ) -> None:
+        if new_state in self.resting_states:
+            new_state = None
+        self.pending[(name, json.dumps(list(key)))] = new_state
+        # all states of one run of Application.update_persistence are staged before this runs
+        if self.write_task is None or self.write_task.done():
+            self.write_task = asyncio.get_running_loop().create_task(self._write())
+
+    async def _write(self) -> None:
+        while True:
+            pending, self.pending = self.pending, {}
+            sessions: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+            removed: Set[str] = set()
+            if self.sessions is not None:
+                sessions, removed = self.sessions.drain_changes()
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._write_batch, pending, sessions, removed
+            )
+            # states staged while writing go into the next batch right away
+            if not self.pending:
+                return
+
+    def _write_batch(
+        self,
+        pending: Dict[Tuple[str, str], Optional[object]],
+        sessions: Dict[str, Tuple[float, Dict[str, Any]]],
+        removed: Set[str],
+    ) -> None:
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [key for key, state in pending.items() if state is None],
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state, updated) VALUES (?, ?, ?, ?)",
+                [
+                    (name, key, json.dumps(state), now)
+                    for (name, key), state in pending.items()
+                    if state is not None
+                ],
+            )
+            self.connection.executemany(
+                "DELETE FROM sessions WHERE key = ?", [(key,) for key in removed]
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO sessions (key, data, expires) VALUES (?, ?, ?)",
+                [
+                    (key, json.dumps(session), expires)
+                    for key, (expires, session) in sessions.items()
+                ],
+            )
+
+    async def flush(self) -> None:
+        if self.write_task is not None:
+            await self.write_task
+        await self._write()
+        with self.lock:
+            self.connection.close()
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Any:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_user_data(self, user_id: int, data: Any) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
+
+
+def get_persistence(
+    config: Dict,
+    outdir: str,
+    sessions: object,
+    executor: Optional[Executor] = None,
+    resting_states: Sequence[object] = (),
+) -> Optional[SqlitePersistence]:
+    """The persistence enabled by `persistence` in env.json, None by default.
+
+    Sessions of a memory session store are saved with the conversations, other stores persist
+    them on their own.
+    """
+    if not config.get("persistence", False):
+        return None
+    return SqlitePersistence(
+        os.path.join(outdir, config.get("persistence_file", "state.sqlite")),
+        sessions if isinstance(sessions, MemorySessionStore) else None,
+        executor,
+        config.get("session_ttl", 3600),
+        resting_states,
+        config.get("persistence_interval", 5),
+    )
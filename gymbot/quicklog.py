@@ -0,0 +1,110 @@
+import difflib
+import re
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Sequence, Set
+
+from gymbot.importer import exercise_key, parse_kg, parse_reps
+from gymbot.exercises import ExerciseRegistry
+
+usage = (
+    "Log sets in one message, e.g. /log squat 100x5, /log bench 80x8x3 for 3 sets "
+    "or /log pushup 25 for bodyweight exercises."
+)
+
+# the most sets logged at once
+max_sets = 20
+
+quick_log_pattern = re.compile(
+    r"^(?P<name>.*?)\s*(?P<numbers>\d+(?:[.,]\d+)?(?:\s*[x×*]\s*\d+(?:[.,]\d+)?)*)$"
+)
+
+number_separator = re.compile(r"\s*[x×*]\s*")
+
+
+class QuickLog(NamedTuple):
+    exercise: str
+    # -1 for bodyweight exercises, like the rows the bot stores
+    kg: str
+    reps: str
+    sets: int
+
+
+class ExerciseMatcher:
+    """Finds the configured exercise meant by a name typed by a user.
+
+    The index is built once from the exercise names: the normalized full names and every prefix of
+    them and of their words map to the exercises, so "bench", "b press" and "squat" are dict
+    lookups. Names not in the index are compared to the full names for typos.
+    """
+
+    def __init__(self, exercises: Sequence[str], min_prefix: int = 2):
+        self.names: Dict[str, str] = {exercise_key(name): name for name in exercises}
+        self.prefixes: Dict[str, Set[str]] = defaultdict(set)
+        for key, name in self.names.items():
+            words = key.split()
+            for i in range(len(words)):
+                # prefixes of the name starting at any word, e.g. "press" for "Bench Press"
+                rest = " ".join(words[i:])
+                for end in range(min_prefix, len(rest) + 1):
+                    self.prefixes[rest[:end]].add(name)
+        self.prefixes = dict(self.prefixes)
+
+    def match(self, text: str) -> List[str]:
+        """The exercises text may mean, one if it is unambiguous."""
+        key = exercise_key(text)
+        if key in self.names:
+            return [self.names[key]]
+        candidates = self.prefixes.get(key)
+        if candidates is None:
+            # prefixes of some of the words, e.g. "b press"
+            words = key.split()
+            candidates = {
+                name
+                for name_key, name in self.names.items()
+                if self._word_prefixes(words, name_key.split())
+            }
+        if candidates:
+            return sorted(candidates)
+        close = difflib.get_close_matches(key, list(self.names), n=3, cutoff=0.75)
+        return [self.names[name_key] for name_key in close]
+
+    @staticmethod
+    def _word_prefixes(words: List[str], name_words: List[str]) -> bool:
+        return len(words) == len(name_words) and all(
+            name_word.startswith(word) for word, name_word in zip(words, name_words)
+        )
+
+
+def parse_quick_log(
+    text: str, matcher: ExerciseMatcher, registry: ExerciseRegistry
+) -> QuickLog:
+    """The sets described by text like `squat 100x5`, `bench 80x8x3` (3 sets) or `pushup 25`.
+
+    Raises ValueError with a message for the user if the text can't be understood.
+    """
+    found = quick_log_pattern.match(text.strip())
+    if found is None or not found.group("name"):
+        raise ValueError(usage)
+    matches = matcher.match(found.group("name"))
+    if not matches:
+        raise ValueError(f"I don't know the exercise {found.group('name')!r}.")
+    if len(matches) > 1:
+        raise ValueError(f"Did you mean {' or '.join(matches)}?")
+    exercise = matches[0]
+    numbers = number_separator.split(found.group("numbers"))
+
+    if registry.get(exercise).bodyweight:
+        if len(numbers) > 2:
+            raise ValueError(
+                f"{exercise} is a bodyweight exercise, use reps or reps x sets."
+            )
+        kg = "-1"
+        reps, sets = numbers[0], numbers[1] if len(numbers) > 1 else "1"
+    else:
+        if len(numbers) < 2 or len(numbers) > 3:
+            raise ValueError(f"Please give kg x reps for {exercise}, e.g. 100x5.")
+        kg = parse_kg(numbers[0])
+        reps, sets = numbers[1], numbers[2] if len(numbers) > 2 else "1"
+    if not sets.isdigit() or not 1 <= int(sets) <= max_sets:
+        raise ValueError(f"sets {sets} is not a whole number from 1 to {max_sets}")
+    return QuickLog(exercise, kg, parse_reps(reps), int(sets))
@@ -0,0 +1,286 @@
+import gzip
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+from typing import Any, Hashable, Iterator, List, NamedTuple, Optional, Tuple
+
+import pandas as pd
+
+from gymbot.codes import ExerciseCodes
+from gymbot.paths import PathResolver
+from gymbot.storage import (
+    CsvStorage,
+    Row,
+    Storage,
+    concat_frames,
+    file_version,
+    filter_range,
+    iter_csv_rows,
+    parse_csv,
+    parse_row,
+    read_csv_from,
+    to_epoch,
+    truncate_file,
+)
+from gymbot.writer import BufferedWriter
+
+
+class Segment(NamedTuple):
+    """An immutable gzip compressed archive of rows rolled over from the hot file."""
+
+    number: int
+    rows: int
+    # size of the uncompressed rows
+    size: int
+    # min and max timestamp of the rows in epoch seconds
+    first: int
+    last: int
+
+
+class SegmentedCsvStorage(CsvStorage):
+    """CSV storage split into a small hot `<hashed_id>.csv` file and compressed archives.
+
+    compact() rolls the hot file over into an immutable `<hashed_id>.<number>.csv.gz` archive once
+    it is larger than `segment_bytes` or its oldest row is older than `segment_days`. The archives
+    and their row counts and timestamp ranges are listed in `<hashed_id>.segments.json`. Range reads
+    only open the archives overlapping the range, and appends only ever touch the hot file.
+
+    Rolling over renames the hot file to `<hashed_id>.<number>.csv.rolling` first, so appends in
+    the meantime go to a new hot file. If the process dies before the rolling file was archived,
+    the next compact() of the user finishes the job.
+    """
+
+    def __init__(
+        self,
+        outdir: str,
+        writer: Optional[BufferedWriter] = None,
+        resolver: Optional[PathResolver] = None,
+        codes: Optional[ExerciseCodes] = None,
+        compact_rows: bool = False,
+        segment_bytes: int = 1 << 20,
+        segment_days: float = 90,
+    ):
+        super().__init__(outdir, writer, resolver, codes, compact_rows)
+        self.segment_bytes = segment_bytes
+        self.segment_days = segment_days
+
+    def segments_path(self, hashed_id: str) -> str:
+        return self.resolver.path(hashed_id, ".segments.json")
+
+    def archive_path(self, hashed_id: str, number: int) -> str:
+        return self.resolver.path(hashed_id, f".{number}.csv.gz")
+
+    def rolling_path(self, hashed_id: str, number: int) -> str:
+        return self.resolver.path(hashed_id, f".{number}.csv.rolling")
+
+    def segments(self, hashed_id: str) -> List[Segment]:
+        try:
+            with open(self.segments_path(hashed_id)) as file:
+                return [Segment(*segment) for segment in json.load(file)]
+        except FileNotFoundError:
+            return []
+
+    def save_segments(self, hashed_id: str, segments: List[Segment]) -> None:
+        path = self.segments_path(hashed_id)
+        if not segments:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with open(path + ".tmp", "w") as file:
+            json.dump([list(segment) for segment in segments], file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+
+    def read_archive(self, hashed_id: str, segment: Segment) -> pd.DataFrame:
+        with gzip.open(self.archive_path(hashed_id, segment.number), "rb") as file:
+            return parse_csv(file.read(), self.codes)
+
+    def read(
+        self,
+        hashed_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> pd.DataFrame:
+        frames = [
+            self.read_archive(hashed_id, segment)
+            for segment in self.segments(hashed_id)
+            if overlaps(segment, start, end)
+        ]
+        frames.append(super().read_from(hashed_id)[0])
+        return filter_range(concat_frames(frames), start, end)
+
+    def version(self, hashed_id: str) -> Hashable:
+        return super().version(hashed_id), file_version(self.segments_path(hashed_id))
+
+    def read_from(
+        self, hashed_id: str, df: Optional[pd.DataFrame] = None, position: Any = None
+    ) -> Tuple[pd.DataFrame, Any]:
+        """Extend df with the rows appended to the hot file, unless it was rolled over since.
+
+        The position is the number of archives and the offset in the hot file df was read up to.
+        """
+        segments = self.segments(hashed_id)
+        # a new archive or a shrunk hot file mean the history has to be read again
+        rolled_over = position is None or position[0] != len(segments)
+        if not rolled_over and file_version(self.path(hashed_id))[0] >= position[1]:
+            df, offset = super().read_from(hashed_id, df, position[1])
+        else:
+            frames = [self.read_archive(hashed_id, segment) for segment in segments]
+            hot, offset = super().read_from(hashed_id)
+            df = concat_frames(frames + [hot])
+        return df, None if offset is None else (len(segments), offset)
+
+    def tail(self, hashed_id: str, n: int = 1) -> pd.DataFrame:
+        df = super().tail(hashed_id, n)
+        if df.empty and self.segments(hashed_id):
+            # the hot file was rolled over, the last rows are in the archives
+            return self.read(hashed_id).tail(n)
+        return df
+
+    def delete_last(self, hashed_id: str) -> bool:
+        if super().delete_last(hashed_id):
+            return True
+
+        # the hot file is empty, move the newest archive back into it
+        segments = self.segments(hashed_id)
+        if not segments:
+            return False
+        segment = segments.pop()
+        archive_path = self.archive_path(hashed_id, segment.number)
+        with gzip.open(archive_path, "rb") as src, open(
+            self.path(hashed_id) + ".tmp", "wb"
+        ) as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(self.path(hashed_id) + ".tmp", self.path(hashed_id))
+        self.save_segments(hashed_id, segments)
+        os.remove(archive_path)
+        return super().delete_last(hashed_id)
+
+    def delete_all(self, hashed_id: str) -> bool:
+        deleted = super().delete_all(hashed_id)
+        segments = self.segments(hashed_id)
+        number = segments[-1].number + 1 if segments else 0
+        for rolling_path in [
+            self.rolling_path(hashed_id, number - 1),
+            self.rolling_path(hashed_id, number),
+        ]:
+            if os.path.exists(rolling_path):
+                os.remove(rolling_path)
+                deleted = True
+        for segment in segments:
+            os.remove(self.archive_path(hashed_id, segment.number))
+            deleted = True
+        self.save_segments(hashed_id, [])
+        return deleted
+
+    def iter_rows(self, hashed_id: str) -> Iterator[Row]:
+        for segment in self.segments(hashed_id):
+            yield from iter_csv_rows(
+                self.archive_path(hashed_id, segment.number), self.codes, gzip.open
+            )
+        yield from super().iter_rows(hashed_id)
+
+    def rename(self, hashed_id: str, new_hashed_id: str) -> bool:
+        """Rename the files of a history, or copy its rows if the new id is in use.
+
+        The archives and rolling files are renamed first and the segments and hot file last, so an
+        interrupted rename continues when it is done again.
+        """
+        if self.writer is not None:
+            self.writer.release(self.path(hashed_id))
+            self.writer.release(self.path(new_hashed_id))
+        if os.path.exists(self.segments_path(new_hashed_id)) or os.path.exists(
+            self.path(new_hashed_id)
+        ):
+            return Storage.rename(self, hashed_id, new_hashed_id)
+
+        segments = self.segments(hashed_id)
+        number = segments[-1].number + 1 if segments else 0
+        paths = [(self.archive_path, segment.number) for segment in segments] + [
+            (self.rolling_path, number - 1),
+            (self.rolling_path, number),
+        ]
+        for path, n in paths:
+            if os.path.exists(path(hashed_id, n)):
+                os.rename(path(hashed_id, n), path(new_hashed_id, n))
+        moved = False
+        for path in [self.segments_path, self.path]:
+            if os.path.exists(path(hashed_id)):
+                os.rename(path(hashed_id), path(new_hashed_id))
+                moved = True
+        return moved
+
+    def hashed_ids(self) -> Iterator[str]:
+        if self.writer is not None:
+            self.writer.flush()
+        # users whose hot file was rolled over have no hot file until their next set
+        hashed_ids = set(self.resolver.hashed_ids(".csv"))
+        hashed_ids.update(self.resolver.hashed_ids(".segments.json"))
+        return iter(sorted(hashed_ids))
+
+    def needs_compaction(self, hashed_id: str) -> bool:
+        try:
+            size = os.path.getsize(self.path(hashed_id))
+            if size >= self.segment_bytes:
+                return True
+            if size == 0:
+                return False
+            with open(self.path(hashed_id)) as file:
+                first = parse_row(file.readline(), self.codes)[1]
+        except (FileNotFoundError, IndexError, ValueError):
+            return False
+        return datetime.now() - first >= timedelta(days=self.segment_days)
+
+    def compact(self, hashed_id: str) -> bool:
+        """Roll the hot file over into a new archive if it is too large or too old."""
+        segments = self.segments(hashed_id)
+        number = segments[-1].number + 1 if segments else 0
+        if segments and os.path.exists(self.rolling_path(hashed_id, number - 1)):
+            # archived before the process died, only the rolling file was left
+            os.remove(self.rolling_path(hashed_id, number - 1))
+
+        rolling_path = self.rolling_path(hashed_id, number)
+        if not os.path.exists(rolling_path):
+            if self.writer is not None:
+                self.writer.flush()
+            if not self.needs_compaction(hashed_id):
+                return False
+            if self.writer is not None:
+                self.writer.release(self.path(hashed_id))
+            os.rename(self.path(hashed_id), rolling_path)
+
+        size = os.path.getsize(rolling_path)
+        df, offset = read_csv_from(rolling_path, 0, self.codes)
+        if offset < size:
+            # drop the interrupted write of a last line
+            truncate_file(rolling_path, offset)
+            size = offset
+        if df.empty:
+            os.remove(rolling_path)
+            return False
+
+        archive_path = self.archive_path(hashed_id, number)
+        with open(rolling_path, "rb") as src, gzip.open(
+            archive_path + ".tmp", "wb"
+        ) as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(archive_path + ".tmp", archive_path)
+
+        timestamps = df["timestamp"].astype("int64")
+        segments.append(
+            Segment(number, len(df), size, int(timestamps.min()), int(timestamps.max()))
+        )
+        self.save_segments(hashed_id, segments)
+        os.remove(rolling_path)
+        return True
+
+
+def overlaps(
+    segment: Segment, start: Optional[datetime], end: Optional[datetime]
+) -> bool:
+    """Whether a segment may hold rows with start <= timestamp < end."""
+    if start is not None and segment.last < to_epoch(start):
+        return False
+    return end is None or segment.first < to_epoch(end)
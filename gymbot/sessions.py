@@ -0,0 +1,248 @@
+import abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+Session = Dict[str, Any]
+
+
+class SessionStore(abc.ABC):
+    """Interface of a store of in-progress selections, e.g. the exercise and kg of a set being logged.
+
+    Sessions are keyed by hashed id and expire `ttl` seconds after they were last stored. At most
+    `max_sessions` are kept, the least recently used ones are evicted first.
+    """
+
+    def __init__(self, ttl: float = 3600, max_sessions: int = 10000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[Session]:
+        """The session of key, None if there is none or it expired."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put(self, key: str, session: Session) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def pop(self, key: str) -> Optional[Session]:
+        """Remove and return the session of key, None if there is none or it expired."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions in a dict of this process.
+
+    After track_changes() the keys of changed sessions are collected, so a persistence can save
+    them in batches with drain_changes().
+    """
+
+    def __init__(self, ttl: float = 3600, max_sessions: int = 10000):
+        super().__init__(ttl, max_sessions)
+        self.sessions: "OrderedDict[str, Tuple[float, Session]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.changed: Optional[Set[str]] = None
+
+    def _remove(self, key: str) -> None:
+        del self.sessions[key]
+        if self.changed is not None:
+            self.changed.add(key)
+
+    def _take(self, key: str, remove: bool) -> Optional[Session]:
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if remove:
+                self._remove(key)
+            else:
+                self.sessions.move_to_end(key)
+            return dict(entry[1])
+
+    def get(self, key: str) -> Optional[Session]:
+        return self._take(key, remove=False)
+
+    def pop(self, key: str) -> Optional[Session]:
+        return self._take(key, remove=True)
+
+    def put(self, key: str, session: Session) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.sessions[key] = (now + self.ttl, dict(session))
+            self.sessions.move_to_end(key)
+            if self.changed is not None:
+                self.changed.add(key)
+            # entries are ordered by last use and share the ttl, so the expired ones come first
+            while self.sessions and next(iter(self.sessions.values()))[0] <= now:
+                self._remove(next(iter(self.sessions)))
+                self.expired += 1
+            while len(self.sessions) > self.max_sessions:
+                self._remove(next(iter(self.sessions)))
+                self.evictions += 1
+
+    def track_changes(self) -> None:
+        with self.lock:
+            self.changed = set()
+
+    def drain_changes(self) -> Tuple[Dict[str, Tuple[float, Session]], Set[str]]:
+        """The sessions stored since the last call, with their expiry as a time.time() timestamp,
+        and the keys of the removed ones."""
+        with self.lock:
+            changed, self.changed = self.changed or set(), set()
+            offset = time.time() - time.monotonic()
+            stored = {
+                key: (self.sessions[key][0] + offset, dict(self.sessions[key][1]))
+                for key in changed
+                if key in self.sessions
+            }
+        return stored, changed - set(stored)
+
+    def restore(self, key: str, expires: float, session: Session) -> None:
+        """Put back a saved session, expires is a time.time() timestamp."""
+        remaining = expires - time.time()
+        if remaining <= 0:
+            return
+        with self.lock:
+            self.sessions[key] = (time.monotonic() + remaining, dict(session))
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+
+class SqliteSessionStore(SessionStore):
+    """Sessions in a SQLite database, shared by all bot processes using the same file.
+
+    Sessions are stored as JSON. Expired sessions and the ones over `max_sessions` are deleted every
+    `cleanup_interval` writes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 3600,
+        max_sessions: int = 10000,
+        cleanup_interval: int = 100,
+    ):
+        super().__init__(ttl, max_sessions)
+        self.path = path
+        self.cleanup_interval = cleanup_interval
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "key TEXT PRIMARY KEY, "
+                "data TEXT NOT NULL, "
+                "expires REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)"
+            )
+
+    def _take(self, key: str, remove: bool) -> Optional[Session]:
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT data, expires FROM sessions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and (remove or row[1] <= time.time()):
+                self.connection.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            if row is not None and row[1] <= time.time():
+                self.expired += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def get(self, key: str) -> Optional[Session]:
+        return self._take(key, remove=False)
+
+    def pop(self, key: str) -> Optional[Session]:
+        return self._take(key, remove=True)
+
+    def put(self, key: str, session: Session) -> None:
+        with self.lock, self.connection:
+            # expires doubles as the time of last use, all sessions share the same ttl
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sessions (key, data, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(session), time.time() + self.ttl),
+            )
+            self.writes += 1
+            if self.writes % self.cleanup_interval == 0:
+                self._cleanup()
+
+    def _cleanup(self) -> None:
+        self.expired += self.connection.execute(
+            "DELETE FROM sessions WHERE expires <= ?", (time.time(),)
+        ).rowcount
+        self.evictions += self.connection.execute(
+            "DELETE FROM sessions WHERE key IN "
+            "(SELECT key FROM sessions ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.max_sessions,),
+        ).rowcount
+
+    def __len__(self) -> int:
+        with self.lock:
+            row = self.connection.execute("SELECT COUNT(*) FROM sessions").fetchone()
+        return row[0]
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def get_session_store(config: Dict, outdir: str) -> SessionStore:
+    """Create the session store selected by `session_store` in env.json, `memory` by default."""
+    ttl = config.get("session_ttl", 3600)
+    max_sessions = config.get("max_sessions", 10000)
+    backend = config.get("session_store", "memory")
+    if backend == "memory":
+        return MemorySessionStore(ttl, max_sessions)
+    if backend == "sqlite":
+        return SqliteSessionStore(
+            os.path.join(outdir, config.get("session_file", "sessions.sqlite")),
+            ttl,
+            max_sessions,
+        )
+    raise ValueError(f"Unknown session store: {backend}")
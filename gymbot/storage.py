@@ -0,0 +1,1044 @@
+import abc
+import calendar
+import contextlib
+import io
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import numpy as np
+import pandas as pd
+
+from gymbot.cache import HistoryCache, LastRows
+from gymbot.codes import ExerciseCodes, get_exercise_codes
+from gymbot.index import UserIndex
+from gymbot.locks import FileLocks
+from gymbot.paths import PathResolver, get_path_resolver
+from gymbot.writer import BufferedWriter
+
+logger = logging.getLogger(__name__)
+
+df_columns = ["group", "timestamp", "exercise", "kg", "reps"]
+
+timestamp_format = "%Y-%m-%d %H:%M:%S"
+
+# (group, timestamp, exercise, kg, reps)
+Row = Tuple[bool, datetime, str, str, str]
+
+
+def format_row(row: Row, codes: Optional[ExerciseCodes] = None) -> str:
+    """Format a row the way it is stored in the per-user CSV files.
+
+    With codes the row is written compactly, e.g. `0,1672567200,3,80,5` instead of
+    `False,2023-01-01 10:00:00,Bench Press,80,5`: the group as a bit, the timestamp in epoch
+    seconds and the exercise as its code.
+    """
+    group, timestamp, exercise, kg, reps = row
+    if codes is not None:
+        return f"{int(bool(group))},{to_epoch(timestamp)},{codes.encode(exercise)},{kg},{reps}"
+    return ",".join(
+        [
+            str(group),
+            timestamp.strftime(timestamp_format),
+            exercise,
+            str(kg),
+            str(reps),
+        ]
+    )
+
+
+def parse_row(line: str, codes: Optional[ExerciseCodes] = None) -> Row:
+    """Parse a compact or legacy line of a per-user CSV file, the inverse of format_row."""
+    group, timestamp, rest = line.rstrip("\r\n").split(",", 2)
+    exercise, kg, reps = rest.rsplit(",", 2)
+    if group in ["0", "1"]:
+        return (
+            group == "1",
+            from_epoch(int(timestamp)),
+            need(codes).decode(int(exercise)),
+            kg,
+            reps,
+        )
+    return (
+        group == "True",
+        datetime.strptime(timestamp, timestamp_format),
+        exercise,
+        kg,
+        reps,
+    )
+
+
+def need(codes: Optional[ExerciseCodes]) -> ExerciseCodes:
+    if codes is None:
+        raise ValueError("Compact rows can't be read without the exercise codes")
+    return codes
+
+
+def empty_frame() -> pd.DataFrame:
+    return typed_frame(pd.DataFrame(columns=df_columns))
+
+
+def typed_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert a history to the dtypes all engines return: bool group, datetime64[s] timestamp,
+    categorical exercise, float kg (-1 for bodyweight sets, which older versions stored with the
+    exercise name as kg) and integer reps."""
+    return df.astype(
+        {
+            "group": bool,
+            "timestamp": "datetime64[s]",
+            "exercise": "category",
+        }
+    ).assign(
+        kg=pd.to_numeric(df["kg"], errors="coerce").fillna(-1).astype("float64"),
+        reps=pd.to_numeric(df["reps"]).astype("int32"),
+    )
+
+
+def parse_csv(data: bytes, codes: Optional[ExerciseCodes] = None) -> pd.DataFrame:
+    """Parse the lines of a per-user CSV file, compact and legacy lines may be mixed."""
+    df = pd.read_csv(
+        io.BytesIO(data), names=df_columns, dtype=str, keep_default_na=False
+    )
+    compact = df["group"].isin(["0", "1"]).to_numpy()
+    group = df["group"].isin(["1", "True"])
+
+    seconds = np.zeros(len(df), dtype="int64")
+    exercise = df["exercise"].to_numpy(dtype=object)
+    if compact.any():
+        seconds[compact] = df["timestamp"][compact].astype("int64")
+        exercise[compact] = need(codes).decode_all(
+            df["exercise"][compact].astype(int).tolist()
+        )
+    if not compact.all():
+        legacy = pd.to_datetime(df["timestamp"][~compact], format=timestamp_format)
+        seconds[~compact] = legacy.astype("datetime64[s]").astype("int64")
+
+    return typed_frame(
+        pd.DataFrame(
+            {
+                "group": group,
+                "timestamp": seconds.astype("datetime64[s]"),
+                "exercise": exercise,
+                "kg": df["kg"],
+                "reps": df["reps"],
+            },
+            columns=df_columns,
+        )
+    )
+
+
+def read_csv_from(
+    path: str, offset: int, codes: Optional[ExerciseCodes] = None
+) -> Tuple[pd.DataFrame, int]:
+    """Parse the complete lines of a per-user CSV file after offset.
+
+    Returns the parsed rows and the offset of the first byte that was not parsed.
+    """
+    with open(path, "rb") as file:
+        file.seek(offset)
+        data = file.read()
+
+    end = data.rfind(b"\n") + 1
+    if end == 0:
+        return empty_frame(), offset
+    return parse_csv(data[:end], codes), offset + end
+
+
+def concat_frames(frames: Sequence[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate histories, keeping the exercise column categorical."""
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return empty_frame()
+    if len(frames) == 1:
+        return frames[0]
+    # categoricals with different categories concatenate to strings
+    df = pd.concat(frames, ignore_index=True)
+    return df.astype({"exercise": "category"})
+
+
+def filter_range(
+    df: pd.DataFrame, start: Optional[datetime] = None, end: Optional[datetime] = None
+) -> pd.DataFrame:
+    """Keep only the rows with start <= timestamp < end."""
+    if start is not None:
+        df = df[df.timestamp >= start]
+    if end is not None:
+        df = df[df.timestamp < end]
+    return df
+
+
+def last_line_offset(
+    fp: BinaryIO, block_size: int = 4096, end: Optional[int] = None
+) -> Optional[int]:
+    """Find where the last non-empty line of a file starts by scanning backwards from its end.
+
+    Only the blocks holding the last line are read, so the cost does not depend on the file size.
+    With end only the bytes before it are searched. Returns None if the file has no lines.
+    """
+    position = fp.seek(0, os.SEEK_END) if end is None else end
+    content_end = None
+    while position > 0:
+        size = min(block_size, position)
+        position -= size
+        fp.seek(position)
+        block = fp.read(size)
+        if content_end is None:
+            stripped = block.rstrip(b"\r\n")
+            if not stripped:
+                continue
+            content_end = position + len(stripped)
+            block = stripped
+        newline = block.rfind(b"\n", 0, content_end - position)
+        if newline != -1:
+            return position + newline + 1
+    return None if content_end is None else 0
+
+
+def truncate_file(path: str, offset: int) -> None:
+    """Cut a file at offset in place, falling back to an atomic copy-and-replace.
+
+    The in-place truncate does not touch the rest of the file. If the filesystem refuses it, the
+    first offset bytes are copied to a temporary file which then replaces the original, so a crash
+    leaves either the old or the new file but never a partial one.
+    """
+    try:
+        with open(path, "r+b") as fp:
+            fp.truncate(offset)
+            fp.flush()
+            os.fsync(fp.fileno())
+        return
+    except OSError as e:
+        logger.warning(f"In-place truncate of {path} failed, rewriting it: {e}")
+
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with open(path, "rb") as src, os.fdopen(fd, "wb") as dst:
+            remaining = offset
+            while remaining > 0:
+                chunk = src.read(min(1 << 20, remaining))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                remaining -= len(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_version(path: str) -> Tuple[int, int]:
+    """Size and modification time of a file, (0, 0) if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return 0, 0
+    return stat.st_size, stat.st_mtime_ns
+
+
+class Storage(abc.ABC):
+    """Interface of a per-user exercise history store.
+
+    Users are identified by their hashed id, rows are (group, timestamp, exercise, kg, reps) tuples
+    and histories are returned as DataFrames with df_columns.
+    """
+
+    @abc.abstractmethod
+    def append(self, hashed_id: str, rows: Sequence[Row]) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read(
+        self,
+        hashed_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def tail(self, hashed_id: str, n: int = 1) -> pd.DataFrame:
+        return self.read(hashed_id).tail(n)
+
+    def last_row(self, hashed_id: str) -> Optional[Row]:
+        """The last stored row, the one delete_last() would delete, None if there is none."""
+        df = self.tail(hashed_id, 1)
+        if df.empty:
+            return None
+        group, timestamp, exercise, kg, reps = df.iloc[-1][df_columns]
+        return (
+            bool(group),
+            timestamp.to_pydatetime(),
+            str(exercise),
+            # bodyweight sets are logged with -1 kg
+            f"{kg:g}" if np.isfinite(kg) else "-1",
+            str(reps),
+        )
+
+    def version(self, hashed_id: str) -> Hashable:
+        """A token that changes whenever the history changes, None if it can't be cached."""
+        return None
+
+    def read_from(
+        self, hashed_id: str, df: Optional[pd.DataFrame] = None, position: Any = None
+    ) -> Tuple[pd.DataFrame, Any]:
+        """Read the full history, extending df, read up to position, if the engine can.
+
+        Returns the history and the position to extend it from next time.
+        """
+        return self.read(hashed_id), None
+
+    @abc.abstractmethod
+    def delete_last(self, hashed_id: str) -> bool:
+        """Delete the newest row, returns False if there was nothing to delete."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_all(self, hashed_id: str) -> bool:
+        """Delete the whole history, returns False if there was nothing to delete."""
+        raise NotImplementedError
+
+    def compact(self, hashed_id: str) -> bool:
+        """Reorganize the stored history if the engine needs to, returns whether it did."""
+        return False
+
+    @abc.abstractmethod
+    def iter_rows(self, hashed_id: str) -> Iterator[Row]:
+        """Stream the history row by row, oldest first, without loading all of it."""
+        raise NotImplementedError
+
+    def rename(self, hashed_id: str, new_hashed_id: str) -> bool:
+        """Move a history to another hashed id, returns False if there was nothing to move.
+
+        Rows already stored under the new id come first. Engines override this with a cheaper move
+        for the common case of an unused new id.
+        """
+        moved = False
+        batch: List[Row] = []
+        for row in self.iter_rows(hashed_id):
+            batch.append(row)
+            if len(batch) >= 1000:
+                self.append(new_hashed_id, batch)
+                batch = []
+            moved = True
+        if batch:
+            self.append(new_hashed_id, batch)
+        self.delete_all(hashed_id)
+        return moved
+
+    @abc.abstractmethod
+    def hashed_ids(self) -> Iterator[str]:
+        """All users with a stored history."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class CsvStorage(Storage):
+    """One `<hashed_id>.csv` file per user, the original layout, located by a PathResolver.
+
+    With a BufferedWriter, appends are queued and group-committed by the writer thread. Reads flush
+    the writer first and deletes close the writer's handle, so they always see every queued row.
+    With `compact_rows` rows are appended in the compact format of format_row(); files may mix both
+    formats, so it can be turned on for existing histories.
+    """
+
+    def __init__(
+        self,
+        outdir: str,
+        writer: Optional[BufferedWriter] = None,
+        resolver: Optional[PathResolver] = None,
+        codes: Optional[ExerciseCodes] = None,
+        compact_rows: bool = False,
+    ):
+        self.outdir = outdir
+        self.writer = writer
+        self.resolver = resolver or PathResolver(outdir)
+        self.codes = codes
+        self.compact_rows = compact_rows
+        if compact_rows:
+            need(codes)
+
+    def path(self, hashed_id: str) -> str:
+        return self.resolver.path(hashed_id, ".csv")
+
+    def append(self, hashed_id: str, rows: Sequence[Row]) -> None:
+        codes = self.codes if self.compact_rows else None
+        data = "".join(format_row(row, codes) + "\n" for row in rows)
+        if self.writer is not None:
+            self.writer.write(self.path(hashed_id), data)
+            return
+        with open(self.path(hashed_id), "a") as file:
+            file.write(data)
+
+    def read(
+        self,
+        hashed_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> pd.DataFrame:
+        return filter_range(self.read_from(hashed_id)[0], start, end)
+
+    def version(self, hashed_id: str) -> Hashable:
+        if self.writer is not None:
+            self.writer.flush()
+        return file_version(self.path(hashed_id))
+
+    def read_from(
+        self, hashed_id: str, df: Optional[pd.DataFrame] = None, position: Any = None
+    ) -> Tuple[pd.DataFrame, Any]:
+        """Parse only the rows appended after the byte offset df was parsed to.
+
+        Falls back to a full parse if there is no offset or the file shrank since.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+        size = file_version(self.path(hashed_id))[0]
+        if df is None or position is None or size < position:
+            try:
+                return read_csv_from(self.path(hashed_id), 0, self.codes)
+            except FileNotFoundError:
+                return empty_frame(), None
+
+        new, position = read_csv_from(self.path(hashed_id), position, self.codes)
+        return concat_frames([df, new]), position
+
+    def tail(self, hashed_id: str, n: int = 1) -> pd.DataFrame:
+        """The last rows, for the last row only the end of the file is read."""
+        if n != 1:
+            return super().tail(hashed_id, n)
+        if self.writer is not None:
+            self.writer.flush()
+        try:
+            with open(self.path(hashed_id), "rb") as fp:
+                offset = last_line_offset(fp)
+                if offset is None:
+                    return empty_frame()
+                fp.seek(offset)
+                data = fp.read()
+        except FileNotFoundError:
+            return empty_frame()
+        if not data.endswith(b"\n"):
+            # a partial line of an interrupted write, which reads skip
+            return super().tail(hashed_id, n)
+        return parse_csv(data, self.codes)
+
+    def delete_last(self, hashed_id: str) -> bool:
+        if self.writer is not None:
+            self.writer.release(self.path(hashed_id))
+        try:
+            with open(self.path(hashed_id), "rb") as fp:
+                offset = last_line_offset(fp)
+                if offset is None:
+                    return False
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) == b"\n":
+                    deleted: Optional[int] = offset
+                else:
+                    # the last row is the line before a partial one of an interrupted write
+                    deleted = last_line_offset(fp, end=offset)
+        except FileNotFoundError:
+            return False
+
+        truncate_file(self.path(hashed_id), offset if deleted is None else deleted)
+        return deleted is not None
+
+    def delete_all(self, hashed_id: str) -> bool:
+        if self.writer is not None:
+            self.writer.release(self.path(hashed_id))
+        try:
+            os.remove(self.path(hashed_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def iter_rows(self, hashed_id: str) -> Iterator[Row]:
+        if self.writer is not None:
+            self.writer.flush()
+        yield from iter_csv_rows(self.path(hashed_id), self.codes)
+
+    def rename(self, hashed_id: str, new_hashed_id: str) -> bool:
+        if self.writer is not None:
+            self.writer.release(self.path(hashed_id))
+            self.writer.release(self.path(new_hashed_id))
+        if os.path.exists(self.path(new_hashed_id)):
+            return super().rename(hashed_id, new_hashed_id)
+        try:
+            os.rename(self.path(hashed_id), self.path(new_hashed_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def hashed_ids(self) -> Iterator[str]:
+        if self.writer is not None:
+            self.writer.flush()
+        return self.resolver.hashed_ids(".csv")
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+def iter_csv_rows(
+    path: str, codes: Optional[ExerciseCodes] = None, opener=open
+) -> Iterator[Row]:
+    """Parse the complete lines of a per-user CSV file one by one."""
+    try:
+        file = opener(path, "rt")
+    except FileNotFoundError:
+        return
+    with file:
+        for line in file:
+            if line.endswith("\n") and line.strip():
+                yield parse_row(line, codes)
+
+
+def to_epoch(timestamp: datetime) -> int:
+    """Naive local timestamps are stored as if they were UTC, so they read back unchanged."""
+    return calendar.timegm(timestamp.timetuple())
+
+
+def from_epoch(seconds: int) -> datetime:
+    return datetime(1970, 1, 1) + timedelta(seconds=int(seconds))
+
+
+class SqliteStorage(Storage):
+    """All users in one embedded SQLite database in WAL mode.
+
+    Rows are indexed by (user, timestamp), so reports are indexed range reads and logging a set is a
+    single insert. The connection is shared between threads and guarded by a lock.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "user TEXT NOT NULL, "
+            "grp INTEGER NOT NULL, "
+            "timestamp INTEGER NOT NULL, "
+            "exercise TEXT NOT NULL, "
+            "kg NUMERIC, "
+            "reps INTEGER)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_user_timestamp ON entries (user, timestamp)"
+        )
+
+    def append(self, hashed_id: str, rows: Sequence[Row]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO entries (user, grp, timestamp, exercise, kg, reps) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (hashed_id, int(group), to_epoch(timestamp), exercise, kg, reps)
+                    for group, timestamp, exercise, kg, reps in rows
+                ],
+            )
+
+    def _frame(self, records) -> pd.DataFrame:
+        df = pd.DataFrame(records, columns=df_columns)
+        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s")
+        return typed_frame(df)
+
+    def read(
+        self,
+        hashed_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> pd.DataFrame:
+        query = "SELECT grp, timestamp, exercise, kg, reps FROM entries WHERE user = ?"
+        params = [hashed_id]
+        if start is not None:
+            query += " AND timestamp >= ?"
+            params.append(to_epoch(start))
+        if end is not None:
+            query += " AND timestamp < ?"
+            params.append(to_epoch(end))
+        with self.lock:
+            records = self.connection.execute(query + " ORDER BY id", params).fetchall()
+        return self._frame(records)
+
+    def tail(self, hashed_id: str, n: int = 1) -> pd.DataFrame:
+        with self.lock:
+            records = self.connection.execute(
+                "SELECT grp, timestamp, exercise, kg, reps FROM entries WHERE user = ? ORDER BY id DESC LIMIT ?",
+                (hashed_id, n),
+            ).fetchall()
+        return self._frame(records[::-1])
+
+    def version(self, hashed_id: str) -> Hashable:
+        # changes when another connection commits, own writes are tracked by CachedStorage
+        with self.lock:
+            return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def delete_last(self, hashed_id: str) -> bool:
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM entries WHERE id = (SELECT MAX(id) FROM entries WHERE user = ?)",
+                (hashed_id,),
+            )
+        return cursor.rowcount > 0
+
+    def delete_all(self, hashed_id: str) -> bool:
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM entries WHERE user = ?", (hashed_id,)
+            )
+        return cursor.rowcount > 0
+
+    def iter_rows(self, hashed_id: str, batch_size: int = 10000) -> Iterator[Row]:
+        last_id = 0
+        while True:
+            with self.lock:
+                records = self.connection.execute(
+                    "SELECT id, grp, timestamp, exercise, kg, reps FROM entries "
+                    "WHERE user = ? AND id > ? ORDER BY id LIMIT ?",
+                    (hashed_id, last_id, batch_size),
+                ).fetchall()
+            for _, group, timestamp, exercise, kg, reps in records:
+                yield bool(group), from_epoch(timestamp), exercise, kg, reps
+            if len(records) < batch_size:
+                return
+            last_id = records[-1][0]
+
+    def rename(self, hashed_id: str, new_hashed_id: str) -> bool:
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "UPDATE entries SET user = ? WHERE user = ?", (new_hashed_id, hashed_id)
+            )
+        return cursor.rowcount > 0
+
+    def hashed_ids(self) -> Iterator[str]:
+        with self.lock:
+            users = self.connection.execute(
+                "SELECT DISTINCT user FROM entries"
+            ).fetchall()
+        return (user for user, in users)
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class LockedStorage(Storage):
+    """Holds an inter-process file lock of the user around every operation of another engine."""
+
+    def __init__(self, storage: Storage, file_locks: FileLocks):
+        self.storage = storage
+        self.file_locks = file_locks
+
+    def append(self, hashed_id: str, rows: Sequence[Row]) -> None:
+        with self.file_locks.hold(hashed_id):
+            self.storage.append(hashed_id, rows)
+
+    def read(
+        self,
+        hashed_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> pd.DataFrame:
+        with self.file_locks.hold(hashed_id):
+            return self.storage.read(hashed_id, start, end)
+
+    def read_from(
+        self, hashed_id: str, df: Optional[pd.DataFrame] = None, position: Any = None
+    ) -> Tuple[pd.DataFrame, Any]:
+        with self.file_locks.hold(hashed_id):
+            return self.storage.read_from(hashed_id, df, position)
+
+    def tail(self, hashed_id: str, n: int = 1) -> pd.DataFrame:
+        with self.file_locks.hold(hashed_id):
+            return self.storage.tail(hashed_id, n)
+
+    def version(self, hashed_id: str) -> Hashable:
+        return self.storage.version(hashed_id)
+
+    def delete_last(self, hashed_id: str) -> bool:
+        with self.file_locks.hold(hashed_id):
+            return self.storage.delete_last(hashed_id)
+
+    def delete_all(self, hashed_id: str) -> bool:
+        with self.file_locks.hold(hashed_id):
+            return self.storage.delete_all(hashed_id)
+
+    def compact(self, hashed_id: str) -> bool:
+        with self.file_locks.hold(hashed_id):
+            return self.storage.compact(hashed_id)
+
+    def iter_rows(self, hashed_id: str) -> Iterator[Row]:
+        return self.storage.iter_rows(hashed_id)
+
+    def rename(self, hashed_id: str, new_hashed_id: str) -> bool:
+        # both locks in stripe order, so two renames can't deadlock
+        stripes = sorted([hashed_id, new_hashed_id], key=self.file_locks.stripe)
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(self.file_locks.hold(stripes[0]))
+            if self.file_locks.stripe(stripes[0]) != self.file_locks.stripe(stripes[1]):
+                stack.enter_context(self.file_locks.hold(stripes[1]))
+            return self.storage.rename(hashed_id, new_hashed_id)
+
+    def hashed_ids(self) -> Iterator[str]:
+        return self.storage.hashed_ids()
+
+    def close(self) -> None:
+        self.storage.close()
+
+
+class IndexedStorage(Storage):
+    """Keeps a UserIndex of another engine's users up to date and answers for unknown users from it.
+
+    Reads of users the complete index doesn't know return an empty history right away, without
+    looking for a file that isn't there.
+    """
+
+    def __init__(self, storage: Storage, index: UserIndex):
+        self.storage = storage
+        self.index = index
+
+    def append(self, hashed_id: str, rows: Sequence[Row]) -> None:
+        # indexed first, a user must never have rows the index doesn't know about
+        self.index.added(hashed_id, len(rows))
+        self.storage.append(hashed_id, rows)
+
+    def read(
+        self,
+        hashed_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> pd.DataFrame:
+        if self.index.is_empty(hashed_id):
+            return empty_frame()
+        return self.storage.read(hashed_id, start, end)
+
+    def read_from(
+        self, hashed_id: str, df: Optional[pd.DataFrame] = None, position: Any = None
+    ) -> Tuple[pd.DataFrame, Any]:
+        if self.index.is_empty(hashed_id):
+            return empty_frame(), None
+        return self.storage.read_from(hashed_id, df, position)
+
+    def tail(self, hashed_id: str, n: int = 1) -> pd.DataFrame:
+        if self.index.is_empty(hashed_id):
+            return empty_frame()
+        return self.storage.tail(hashed_id, n)
+
+    def version(self, hashed_id: str) -> Hashable:
+        if self.index.is_empty(hashed_id):
+            # the version of a file that isn't there
+            return 0, 0
+        return self.storage.version(hashed_id)
+
+    def delete_last(self, hashed_id: str) -> bool:
+        if self.index.is_empty(hashed_id):
+            return False
+        deleted = self.storage.delete_last(hashed_id)
+        if deleted:
+            self.index.deleted_last(hashed_id)
+        return deleted
+
+    def delete_all(self, hashed_id: str) -> bool:
+        deleted = self.storage.delete_all(hashed_id)
+        self.index.deleted_all(hashed_id)
+        return deleted
+
+    def compact(self, hashed_id: str) -> bool:
+        return self.storage.compact(hashed_id)
+
+    def iter_rows(self, hashed_id: str) -> Iterator[Row]:
+        if self.index.is_empty(hashed_id):
+            return iter([])
+        return self.storage.iter_rows(hashed_id)
+
+    def rename(self, hashed_id: str, new_hashed_id: str) -> bool:
+        stats = self.index.get(hashed_id)
+        if stats is not None:
+            self.index.added(new_hashed_id, stats.rows)
+        moved = self.storage.rename(hashed_id, new_hashed_id)
+        self.index.deleted_all(hashed_id)
+        if moved:
+            # counted again, an index still being built may not know the old id yet
+            self.index.count_rows(new_hashed_id, self.storage.iter_rows(new_hashed_id))
+        return moved
+
+    def hashed_ids(self) -> Iterator[str]:
+        return self.storage.hashed_ids()
+
+    def close(self) -> None:
+        self.index.close()
+        self.storage.close()
+
+
+class CachedStorage(Storage):
+    """Keeps the parsed histories of the most recent users of another storage engine in memory.
+
+    A cached history is used as long as the engine's version() of it is unchanged and no write went
+    through this instance since it was read, so repeated reports don't parse the history again.
+    After appends the engine extends the stale history with read_from(); deletes and compactions
+    that rewrote files drop it.
+    Range queries are answered from the cached full history, or by the engine if there is none.
+    With `extend` off stale histories are read again in full, which is needed when other processes
+    write too: their deletes aren't seen here, and a history rewritten to the same or a larger size
+    can't be told apart from one that was appended to.
+    """
+
+    def __init__(self, storage: Storage, cache: HistoryCache, extend: bool = True):
+        self.storage = storage
+        self.cache = cache
+        self.extend = extend
+        self.writes: Dict[str, int] = {}
+        self.extended = 0
+
+    def _changed(self, hashed_id: str) -> None:
+        self.writes[hashed_id] = self.writes.get(hashed_id, 0) + 1
+
+    def append(self, hashed_id: str, rows: Sequence[Row]) -> None:
+        self._changed(hashed_id)
+        self.storage.append(hashed_id, rows)
+
+    def read(
+        self,
+        hashed_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> pd.DataFrame:
+        # the version is taken before reading, a write in between makes the entry stale
+        version = (self.writes.get(hashed_id, 0), self.storage.version(hashed_id))
+        df = self.cache.get(hashed_id, version)
+        if df is None:
+            stale = self.cache.stale(hashed_id) if self.extend else None
+            if stale is None and (start is not None or end is not None):
+                # a cold range read, the engine can skip what is out of range
+                return self.storage.read(hashed_id, start, end)
+            if stale is None:
+                df, position = self.storage.read_from(hashed_id)
+            else:
+                df, position = self.storage.read_from(
+                    hashed_id, stale.df, stale.position
+                )
+                self.extended += position is not None
+            self.cache.put(hashed_id, version, df, position)
+        return filter_range(df, start, end)
+
+    def tail(self, hashed_id: str, n: int = 1) -> pd.DataFrame:
+        return self.storage.tail(hashed_id, n)
+
+    def version(self, hashed_id: str) -> Hashable:
+        return self.writes.get(hashed_id, 0), self.storage.version(hashed_id)
+
+    def delete_last(self, hashed_id: str) -> bool:
+        self._changed(hashed_id)
+        try:
+            return self.storage.delete_last(hashed_id)
+        finally:
+            self.cache.invalidate(hashed_id)
+
+    def delete_all(self, hashed_id: str) -> bool:
+        self._changed(hashed_id)
+        try:
+            return self.storage.delete_all(hashed_id)
+        finally:
+            self.cache.invalidate(hashed_id)
+
+    def compact(self, hashed_id: str) -> bool:
+        compacted = True
+        try:
+            compacted = self.storage.compact(hashed_id)
+            return compacted
+        finally:
+            # the rows are the same, but read positions into the old files are not valid anymore
+            if compacted:
+                self._changed(hashed_id)
+                self.cache.invalidate(hashed_id)
+
+    def iter_rows(self, hashed_id: str) -> Iterator[Row]:
+        return self.storage.iter_rows(hashed_id)
+
+    def rename(self, hashed_id: str, new_hashed_id: str) -> bool:
+        self._changed(hashed_id)
+        self._changed(new_hashed_id)
+        try:
+            return self.storage.rename(hashed_id, new_hashed_id)
+        finally:
+            self.cache.invalidate(hashed_id)
+            self.cache.invalidate(new_hashed_id)
+
+    def hashed_ids(self) -> Iterator[str]:
+        return self.storage.hashed_ids()
+
+    def close(self) -> None:
+        logger.warning(
+            f"History cache: {self.cache.stats()}, extended: {self.extended}"
+        )
+        self.storage.close()
+
+
+class LastRowStorage(Storage):
+    """Remembers the last row of the most recent users of another storage engine in memory.
+
+    Appends through this instance set the last row, so repeating a set right after logging it needs
+    no read. Only writes of this process are seen, it must not be used when several processes share
+    the histories.
+    """
+
+    def __init__(self, storage: Storage, rows: LastRows):
+        self.storage = storage
+        self.rows = rows
+
+    def append(self, hashed_id: str, rows: Sequence[Row]) -> None:
+        try:
+            self.storage.append(hashed_id, rows)
+        except BaseException:
+            self.rows.invalidate(hashed_id)
+            raise
+        if rows:
+            self.rows.put(hashed_id, rows[-1])
+
+    def read(
+        self,
+        hashed_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> pd.DataFrame:
+        return self.storage.read(hashed_id, start, end)
+
+    def read_from(
+        self, hashed_id: str, df: Optional[pd.DataFrame] = None, position: Any = None
+    ) -> Tuple[pd.DataFrame, Any]:
+        return self.storage.read_from(hashed_id, df, position)
+
+    def tail(self, hashed_id: str, n: int = 1) -> pd.DataFrame:
+        return self.storage.tail(hashed_id, n)
+
+    def last_row(self, hashed_id: str) -> Optional[Row]:
+        known, row = self.rows.get(hashed_id)
+        if not known:
+            row = self.storage.last_row(hashed_id)
+            self.rows.put(hashed_id, row)
+        return row
+
+    def version(self, hashed_id: str) -> Hashable:
+        return self.storage.version(hashed_id)
+
+    def delete_last(self, hashed_id: str) -> bool:
+        try:
+            return self.storage.delete_last(hashed_id)
+        finally:
+            self.rows.invalidate(hashed_id)
+
+    def delete_all(self, hashed_id: str) -> bool:
+        try:
+            return self.storage.delete_all(hashed_id)
+        finally:
+            self.rows.put(hashed_id, None)
+
+    def compact(self, hashed_id: str) -> bool:
+        return self.storage.compact(hashed_id)
+
+    def iter_rows(self, hashed_id: str) -> Iterator[Row]:
+        return self.storage.iter_rows(hashed_id)
+
+    def rename(self, hashed_id: str, new_hashed_id: str) -> bool:
+        try:
+            return self.storage.rename(hashed_id, new_hashed_id)
+        finally:
+            self.rows.invalidate(hashed_id)
+            self.rows.invalidate(new_hashed_id)
+
+    def hashed_ids(self) -> Iterator[str]:
+        return self.storage.hashed_ids()
+
+    def close(self) -> None:
+        logger.warning(f"Last rows: {self.rows.stats()}")
+        self.storage.close()
+
+
+def get_storage(
+    config: Dict,
+    outdir: str,
+    resolver: Optional[PathResolver] = None,
+    index: Optional[UserIndex] = None,
+) -> Storage:
+    """Create the storage engine selected by the `storage` key of env.json (`csv` by default).
+
+    With `file_locks` the engine is wrapped in a LockedStorage, with an index in an IndexedStorage,
+    unless `history_cache_mb` is 0 in a CachedStorage, and unless `last_rows` is 0 or other
+    processes may write with `file_locks` in a LastRowStorage.
+    """
+    if config.get("file_locks", False) and config.get("buffered_writes", False):
+        # the writer thread would append outside the lock, e.g. between another process finding
+        # and truncating the last line in delete_last
+        raise ValueError("buffered_writes can't be combined with file_locks")
+    storage = get_engine(config, outdir, resolver or get_path_resolver(config, outdir))
+    if config.get("file_locks", False):
+        storage = LockedStorage(storage, FileLocks(os.path.join(outdir, "locks")))
+    if index is not None:
+        storage = IndexedStorage(storage, index)
+    cache_mb = config.get("history_cache_mb", 64)
+    if cache_mb > 0:
+        storage = CachedStorage(
+            storage,
+            HistoryCache(int(cache_mb * 1024 * 1024)),
+            extend=not config.get("file_locks", False),
+        )
+    last_rows = config.get("last_rows", 100000)
+    if last_rows > 0 and not config.get("file_locks", False):
+        storage = LastRowStorage(storage, LastRows(last_rows))
+    return storage
+
+
+def get_engine(config: Dict, outdir: str, resolver: PathResolver) -> Storage:
+    engine = config.get("storage", "csv")
+    if engine == "csv":
+        codes = get_exercise_codes(config, outdir)
+        compact_rows = config.get("compact_rows", False)
+        writer = None
+        if config.get("buffered_writes", False):
+            writer = BufferedWriter(
+                flush_interval=config.get("flush_interval", 1.0),
+                batch_size=config.get("flush_batch_size", 100),
+                max_open_files=config.get("max_open_files", 64),
+                fsync=config.get("fsync", True),
+            )
+        if config.get("archive_segments", False):
+            from gymbot.segments import SegmentedCsvStorage
+
+            return SegmentedCsvStorage(
+                outdir,
+                writer,
+                resolver,
+                codes,
+                compact_rows,
+                segment_bytes=config.get("segment_bytes", 1 << 20),
+                segment_days=config.get("segment_days", 90),
+            )
+        return CsvStorage(outdir, writer, resolver, codes, compact_rows)
+    if engine == "sqlite":
+        return SqliteStorage(
+            os.path.join(outdir, config.get("sqlite_file", "gymbot.sqlite"))
+        )
+    if engine == "columnar":
+        from gymbot.columnar import ColumnarStorage
+
+        return ColumnarStorage(outdir, get_exercise_codes(config, outdir), resolver)
+    raise ValueError(f"Unknown storage engine: {engine}")
@@ -0,0 +1,56 @@
+import pytest
+
+from gymbot.callbacks import Selection, decode_selection, encode_selection
+from gymbot.codes import ExerciseCodes
+from gymbot.exercises import ExerciseRegistry
+from gymbot.keyboards import Keyboards
+
+
+@pytest.mark.parametrize(
+    "selection",
+    [
+        Selection(0),
+        Selection(3, "100"),
+        Selection(3, -1, "5"),
+        Selection(3, "80", "5", 4),
+    ],
+)
+def test_selections_decode_as_encoded(selection):
+    assert decode_selection(encode_selection(selection)) == selection
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        "Squat",
+        "#",
+        "#x:100:5",
+        "#-1:100:5",
+        "#0:100:5:x",
+        "#0:100:5:0",
+        "#0:100:5:100000000",
+    ],
+)
+def test_invalid_callback_data_decodes_to_none(data):
+    assert decode_selection(data) is None
+
+
+@pytest.mark.parametrize(
+    "exercise, kg, reps, sets, offered",
+    [
+        ("Squat", "100", "5", 1, True),
+        ("Squat", "100", "5", 5, True),
+        ("Squat", "100", "5", 0, False),
+        ("Squat", "100", "5", 6, False),
+        ("Squat", "101", "5", 1, False),
+        ("Squat", -1, "5", 1, False),
+        ("Squat", "100", "0", 1, False),
+        ("Squat", "100", "500", 1, False),
+        ("Pushup", -1, "20", 1, True),
+        ("Pushup", "100", "20", 1, False),
+    ],
+)
+def test_keyboards_offer_only_their_sets(tmp_path, exercise, kg, reps, sets, offered):
+    registry = ExerciseRegistry(["Squat", "Pushup"])
+    codes = ExerciseCodes(str(tmp_path / "exercise_codes.json"), registry.names)
+    assert Keyboards(registry, codes).offers(exercise, kg, reps, sets) == offered
@@ -0,0 +1,64 @@
+import gzip
+import io
+from datetime import datetime, timedelta
+
+import pytest
+from telegram import Document, InputFile
+from telegram._utils.files import parse_file_input
+
+from gymbot.exercises import ExerciseRegistry
+from gymbot.export import export_filename, export_formats, export_history
+from gymbot.importer import parse_upload
+from gymbot.storage import get_storage
+
+hashed_id = "ab12cd34ef56"
+
+
+@pytest.mark.parametrize("export_format", export_formats)
+@pytest.mark.parametrize("count", [3, 30000])
+def test_export_uploads_as_document(tmp_path, export_format, count):
+    """Exports of short and long histories go through the upload path of send_document."""
+    storage = get_storage({"exercises": ["Squat"]}, str(tmp_path))
+    start = datetime(2024, 1, 1)
+    storage.append(
+        hashed_id,
+        [
+            (False, start + timedelta(minutes=i), "Squat", "100", str(i % 50 + 1))
+            for i in range(count)
+        ],
+    )
+    data, exported = export_history(storage, hashed_id, export_format)
+    storage.close()
+
+    upload = parse_file_input(
+        data, tg_type=Document, filename=export_filename(export_format)
+    )
+    assert isinstance(upload, InputFile)
+    assert upload.filename == f"gymbot-history.{export_format}.gz"
+    lines = gzip.decompress(upload.input_file_content).decode().splitlines()
+    assert exported == count
+    assert len(lines) == count + (export_format == "csv")
+
+
+@pytest.mark.parametrize("export_format", export_formats)
+def test_export_imports_again(tmp_path, export_format):
+    """Exports, including bodyweight sets stored the way older versions did, import unchanged."""
+    registry = ExerciseRegistry(["Squat", "Pushup"])
+    storage = get_storage({"exercises": registry.names}, str(tmp_path))
+    rows = [
+        (False, datetime(2024, 1, 1, 10), "Squat", "102.5", "5"),
+        (True, datetime(2024, 1, 1, 11), "Pushup", "-1", "20"),
+    ]
+    storage.append(hashed_id, rows)
+    # the kg of bodyweight sets logged by older versions
+    storage.append(
+        hashed_id, [(False, datetime(2024, 1, 1, 12), "Pushup", "Pushup", "15")]
+    )
+    data, _ = export_history(storage, hashed_id, export_format)
+    storage.close()
+
+    result = parse_upload(io.BytesIO(data), registry)
+    assert result.errors == []
+    assert result.rows == rows + [
+        (False, datetime(2024, 1, 1, 12), "Pushup", "-1", "15")
+    ]
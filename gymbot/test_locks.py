@@ -0,0 +1,158 @@
+import asyncio
+import multiprocessing
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+import pytest
+from telegram import CallbackQuery, Update, User
+
+from gymbot.locks import PerUserUpdateProcessor, UserLocks, fcntl
+from gymbot.storage import Row, get_storage
+
+hashed_id = "ab12cd34ef56"
+
+exercises = ["Squat", "Pushup"]
+
+
+def make_row(i: int) -> Row:
+    return False, datetime(2024, 1, 1) + timedelta(minutes=i), "Squat", "100", str(i)
+
+
+def reps(storage, user: str) -> List[str]:
+    return [str(r) for r in storage.read(user)["reps"]]
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"exercises": exercises},
+        {"exercises": exercises, "buffered_writes": True, "flush_interval": 0.01},
+        {"exercises": exercises, "file_locks": True},
+        {"exercises": exercises, "storage": "sqlite"},
+    ],
+)
+def test_user_locks_serialize_mixed_operations(tmp_path, config):
+    """Concurrent appends, deletes and reads of one user through UserLocks leave the history the
+    operations describe when applied one after the other."""
+    storage = get_storage(config, str(tmp_path))
+    locks = UserLocks()
+    executor = ThreadPoolExecutor(8)
+    expected: List[str] = []
+    mismatches = []
+
+    async def operation(i: int, kind: str) -> None:
+        loop = asyncio.get_running_loop()
+        async with locks.hold(hashed_id):
+            if kind == "append":
+                rows = [make_row(i), make_row(i + 100000)]
+                await loop.run_in_executor(executor, storage.append, hashed_id, rows)
+                expected.extend(str(row[4]) for row in rows)
+            elif kind == "delete_last":
+                deleted = await loop.run_in_executor(
+                    executor, storage.delete_last, hashed_id
+                )
+                if deleted != bool(expected):
+                    mismatches.append((i, kind))
+                if expected:
+                    expected.pop()
+            elif kind == "delete_all":
+                await loop.run_in_executor(executor, storage.delete_all, hashed_id)
+                expected.clear()
+            else:
+                found = await loop.run_in_executor(executor, reps, storage, hashed_id)
+                if found != expected:
+                    mismatches.append((i, kind))
+
+    async def run() -> None:
+        kinds = ["append"] * 6 + ["delete_last"] * 3 + ["read"] * 3 + ["delete_all"]
+        rng = random.Random(0)
+        await asyncio.gather(*(operation(i, rng.choice(kinds)) for i in range(400)))
+
+    try:
+        asyncio.run(run())
+        assert mismatches == []
+        assert reps(storage, hashed_id) == expected
+        assert locks.locks == {} and locks.users == {}
+    finally:
+        executor.shutdown()
+        storage.close()
+
+
+def append_and_delete(outdir: str, appends: int, deletes: int) -> Tuple[int, int]:
+    storage = get_storage({"exercises": exercises, "file_locks": True}, outdir)
+    deleted = 0
+    try:
+        for i in range(appends):
+            storage.append(hashed_id, [make_row(i)])
+            storage.read(hashed_id)
+            if i % (appends // deletes) == 0 and storage.delete_last(hashed_id):
+                deleted += 1
+    finally:
+        storage.close()
+    return appends, deleted
+
+
+@pytest.mark.skipif(fcntl is None, reason="file locks need fcntl")
+def test_file_locks_serialize_processes(tmp_path):
+    """Processes appending to and deleting from one user's history with file_locks lose no rows."""
+    outdir = str(tmp_path)
+    # create the exercise codes before the processes race to
+    get_storage({"exercises": exercises, "file_locks": True}, outdir).close()
+    with multiprocessing.get_context().Pool(4) as pool:
+        results = pool.starmap(append_and_delete, [(outdir, 60, 10)] * 4)
+
+    storage = get_storage({"exercises": exercises, "file_locks": True}, outdir)
+    try:
+        df = storage.read(hashed_id)
+    finally:
+        storage.close()
+    appended = sum(result[0] for result in results)
+    deleted = sum(result[1] for result in results)
+    assert len(df) == appended - deleted
+    assert set(df["exercise"]) == {"Squat"}
+    assert df["reps"].astype(int).between(0, 59).all()
+
+
+def user_update(update_id: int, user_id: int) -> Update:
+    user = User(user_id, "user", False)
+    return Update(update_id, callback_query=CallbackQuery(str(update_id), user, "chat"))
+
+
+def test_updates_of_one_user_leave_slots_to_others():
+    """Updates queued behind a user's lock don't count against max_concurrent_updates."""
+
+    async def run() -> List[int]:
+        processor = PerUserUpdateProcessor(2)
+        await processor.initialize()
+        release = asyncio.Event()
+        done: List[int] = []
+
+        async def handle(update_id: int, wait: bool) -> None:
+            if wait:
+                await release.wait()
+            done.append(update_id)
+
+        busy = [
+            asyncio.ensure_future(
+                processor.process_update(user_update(i, 1), handle(i, True))
+            )
+            for i in range(5)
+        ]
+        await asyncio.wait_for(
+            processor.process_update(user_update(9, 2), handle(9, False)), 1
+        )
+        release.set()
+        await asyncio.gather(*busy)
+        return done
+
+    assert asyncio.run(run()) == [9, 0, 1, 2, 3, 4]
+
+
+def test_file_locks_reject_buffered_writes(tmp_path):
+    with pytest.raises(ValueError):
+        get_storage(
+            {"exercises": exercises, "file_locks": True, "buffered_writes": True},
+            str(tmp_path),
+        )
@@ -0,0 +1,75 @@
+import os
+from datetime import datetime, timedelta
+
+from gymbot.migrate import engine_config, migrate, read_journal, summarize
+from gymbot.paths import get_path_resolver
+from gymbot.storage import Storage, get_engine
+
+config = {"exercises": ["Squat", "Pushup"]}
+
+hashed_ids = ["aaaa1111", "bbbb2222", "cccc3333"]
+
+
+def engine(outdir: str, name: str) -> Storage:
+    return get_engine(
+        engine_config(config, name), outdir, get_path_resolver(config, outdir)
+    )
+
+
+def append(outdir: str, hashed_id: str, count: int) -> None:
+    storage = engine(outdir, "csv")
+    start = datetime(2024, 1, 1) + timedelta(
+        hours=len(list(storage.iter_rows(hashed_id)))
+    )
+    storage.append(
+        hashed_id,
+        [
+            (False, start + timedelta(minutes=i), "Squat", "100", "5")
+            for i in range(count)
+        ],
+    )
+    storage.close()
+
+
+def assert_copied(outdir: str) -> None:
+    source, target = engine(outdir, "csv"), engine(outdir, "sqlite")
+    try:
+        assert set(target.hashed_ids()) == set(hashed_ids)
+        for hashed_id in hashed_ids:
+            assert summarize(target.iter_rows(hashed_id)) == summarize(
+                source.iter_rows(hashed_id)
+            )
+    finally:
+        source.close()
+        target.close()
+
+
+def test_migration_resumes_and_catches_up(tmp_path):
+    """An interrupted migration copies only the users left, a run after new sets only their users."""
+    outdir = str(tmp_path)
+    journal_path = os.path.join(outdir, "migrate.journal")
+    for i, hashed_id in enumerate(hashed_ids):
+        append(outdir, hashed_id, 10 * (i + 1))
+
+    migrated, failed = migrate(config, outdir, "csv", "sqlite", journal_path, workers=2)
+    assert (migrated, failed) == (3, [])
+    assert_copied(outdir)
+    journal = read_journal(journal_path)
+
+    # a run interrupted while writing the journal line of the second user
+    with open(journal_path, "w") as file:
+        file.write(
+            f"{hashed_ids[0]}\t{journal[hashed_ids[0]][0]}\t{journal[hashed_ids[0]][1]}\n"
+        )
+        file.write(f"{hashed_ids[1]}\t20")
+    assert migrate(config, outdir, "csv", "sqlite", journal_path) == (2, [])
+    assert read_journal(journal_path) == journal
+
+    append(outdir, hashed_ids[1], 5)
+    assert migrate(config, outdir, "csv", "sqlite", journal_path) == (1, [])
+    assert_copied(outdir)
+    with open(journal_path) as file:
+        lines = file.read().splitlines()
+    assert [line.split("\t")[:2] for line in lines[-1:]] == [[hashed_ids[1], "25"]]
+
+    assert migrate(config, outdir, "csv", "sqlite", journal_path) == (0, [])
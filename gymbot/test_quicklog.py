@@ -0,0 +1,48 @@
+import pytest
+
+from gymbot.exercises import ExerciseRegistry
+from gymbot.quicklog import ExerciseMatcher, QuickLog, max_sets, parse_quick_log
+
+exercises = ["Squat", "Bench Press", "Bent Over Row", "Pushup", "Deadlift"]
+
+
+def parse(text: str) -> QuickLog:
+    registry = ExerciseRegistry(exercises, {"Pushup": {"kind": "bodyweight"}})
+    return parse_quick_log(text, ExerciseMatcher(exercises), registry)
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("squat 100x5", QuickLog("Squat", "100", "5", 1)),
+        ("bench 80x8x3", QuickLog("Bench Press", "80", "8", 3)),
+        ("b press 80x8", QuickLog("Bench Press", "80", "8", 1)),
+        ("Squat 102,5 x 5", QuickLog("Squat", "102.5", "5", 1)),
+        ("pushup 25", QuickLog("Pushup", "-1", "25", 1)),
+        ("pushup 25x3", QuickLog("Pushup", "-1", "25", 3)),
+        ("deadlfit 140x3", QuickLog("Deadlift", "140", "3", 1)),
+        (f"squat 100x5x{max_sets}", QuickLog("Squat", "100", "5", max_sets)),
+    ],
+)
+def test_quick_log_parses(text, expected):
+    assert parse(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text, message",
+    [
+        ("be 80x8", "Did you mean Bench Press or Bent Over Row?"),
+        ("curls 20x10", "I don't know the exercise 'curls'."),
+        ("squat 100", "Please give kg x reps for Squat"),
+        ("pushup 25x3x2", "Pushup is a bodyweight exercise"),
+        (f"squat 100x5x{max_sets + 1}", f"from 1 to {max_sets}"),
+        ("squat 100x5x0", f"from 1 to {max_sets}"),
+        ("squat 100x0", "reps 0 is not"),
+        ("100x5", "Log sets in one message"),
+        ("squat", "Log sets in one message"),
+    ],
+)
+def test_quick_log_rejects(text, message):
+    with pytest.raises(ValueError) as error:
+        parse(text)
+    assert message in str(error.value)
@@ -0,0 +1,87 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from gymbot.codes import get_exercise_codes
+from gymbot.columnar import ColumnarStorage, convert_csv_files
+from gymbot.paths import get_path_resolver
+from gymbot.storage import get_engine
+
+hashed_id = "ab12cd34ef56"
+
+rows = [
+    (False, datetime(2024, 1, 1, 10), "Squat", "82.5", "5"),
+    # a bodyweight set as older versions logged it, with the exercise name as kg
+    (True, datetime(2024, 1, 1, 11), "Pushup", "Pushup", "15"),
+    (False, datetime(2024, 1, 1, 12), "Pushup", "-1", "20"),
+]
+
+
+def read(engine: str, outdir: str) -> pd.DataFrame:
+    config = {"exercises": ["Squat", "Pushup"], "storage": engine}
+    os.makedirs(outdir)
+    storage = get_engine(config, outdir, get_path_resolver(config, outdir))
+    try:
+        storage.append(hashed_id, rows)
+        return storage.read(hashed_id)
+    finally:
+        storage.close()
+
+
+@pytest.mark.parametrize("engine", ["sqlite", "columnar"])
+def test_engines_read_the_same_frame(tmp_path, engine):
+    """Every engine returns the dtypes and values of the csv engine, -1 kg for bodyweight sets."""
+    expected = read("csv", str(tmp_path / "csv"))
+    assert list(expected["kg"]) == [82.5, -1, -1]
+    pd.testing.assert_frame_equal(
+        read(engine, str(tmp_path / engine)), expected, check_categorical=False
+    )
+
+
+@pytest.mark.parametrize("archive_segments", [False, True])
+def test_last_row_reads_the_end_of_the_csv_file(tmp_path, archive_segments):
+    config = {
+        "exercises": ["Squat", "Pushup"],
+        "archive_segments": archive_segments,
+        "segment_bytes": 1,
+    }
+    outdir = str(tmp_path)
+    storage = get_engine(config, outdir, get_path_resolver(config, outdir))
+    assert storage.last_row(hashed_id) is None
+    storage.append(hashed_id, rows[:2])
+    assert storage.last_row(hashed_id) == (*rows[1][:3], "-1", "15")
+    storage.compact(hashed_id)
+    storage.append(hashed_id, rows[2:])
+    with open(storage.path(hashed_id), "a") as file:
+        # an interrupted write
+        file.write("False,2024-01-01 13:00:00,Squ")
+    assert storage.last_row(hashed_id) == rows[2]
+    # the partial line goes together with the row last_row() returned
+    assert storage.delete_last(hashed_id)
+    assert storage.last_row(hashed_id) == (*rows[1][:3], "-1", "15")
+    with open(storage.path(hashed_id), "rb") as file:
+        assert file.read()[-1:] in [b"", b"\n"]
+    storage.delete_all(hashed_id)
+    with open(storage.path(hashed_id), "a") as file:
+        file.write("False,2024-01-01 13:00:00,Squ")
+    assert not storage.delete_last(hashed_id)
+    assert os.path.getsize(storage.path(hashed_id)) == 0
+
+
+def test_convert_reads_compact_rows(tmp_path):
+    config = {"exercises": ["Squat", "Pushup"], "compact_rows": True}
+    outdir = str(tmp_path)
+    resolver = get_path_resolver(config, outdir)
+    storage = get_engine(config, outdir, resolver)
+    storage.append(hashed_id, rows)
+    expected = storage.read(hashed_id)
+    storage.close()
+
+    codes = get_exercise_codes(config, outdir)
+    assert convert_csv_files(outdir, codes, resolver) == [hashed_id]
+    columnar = ColumnarStorage(outdir, codes, resolver)
+    pd.testing.assert_frame_equal(
+        columnar.read(hashed_id), expected, check_categorical=False
+    )
@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+from datetime import datetime
+
+import pytest
+
+from gymbot.executor import IOExecutor
+from gymbot.index import UserIndex
+from gymbot.locks import UserLocks
+from gymbot.storage import CsvStorage, IndexedStorage
+from gymbot.users import LegacyRenames, UserIds, ZeroMd5
+
+rows = [(False, datetime(2024, 1, 1, 10), "Squat", "100", "5")]
+
+
+def legacy_hashed(user_id: int) -> str:
+    return hashlib.md5(bytes(user_id)).hexdigest()
+
+
+def make_user_ids(tmp_path, legacy) -> UserIds:
+    user_ids = UserIds(
+        str(tmp_path / "legacy_user_ids.txt"),
+        zero_md5=ZeroMd5(checkpoint_bytes=64, chunk_bytes=16),
+    )
+    user_ids.load_legacy(legacy)
+    return user_ids
+
+
+@pytest.mark.parametrize("n", [0, 1, 15, 16, 63, 64, 65, 128, 200, 1000])
+def test_zero_md5_is_md5_of_zeros(n):
+    zero_md5 = ZeroMd5(checkpoint_bytes=64, chunk_bytes=16)
+    assert zero_md5.hexdigest(n) == legacy_hashed(n)
+    # again from the checkpoints built meanwhile
+    assert zero_md5.hexdigest(n) == legacy_hashed(n)
+
+
+def test_zero_md5_built_ahead():
+    zero_md5 = ZeroMd5(checkpoint_bytes=64, chunk_bytes=16)
+    zero_md5.build(300)
+    assert len(zero_md5.checkpoints) == 5
+    assert [zero_md5.hexdigest(n) for n in [70, 299, 500]] == [
+        legacy_hashed(n) for n in [70, 299, 500]
+    ]
+
+
+def test_legacy_id_only_of_histories_left(tmp_path):
+    user_ids = make_user_ids(tmp_path, [legacy_hashed(1000)])
+    assert user_ids.legacy_id(1000) == legacy_hashed(1000)
+    assert user_ids.legacy_id(1001) is None
+    assert user_ids.legacy_id(-1000) is None
+    user_ids.renamed(legacy_hashed(1000))
+    assert not user_ids.legacy_left
+    assert user_ids.legacy_id(1000) is None
+    # the list of histories left is kept on disk
+    assert not make_user_ids(tmp_path, [legacy_hashed(1000)]).legacy_left
+
+
+def test_first_contact_renames_the_legacy_history(tmp_path):
+    storage = CsvStorage(str(tmp_path))
+    storage.append(legacy_hashed(1000), rows)
+    storage.append(legacy_hashed(2000), rows)
+    user_ids = make_user_ids(tmp_path, storage.hashed_ids())
+    io_executor = IOExecutor(2)
+    renames = LegacyRenames(user_ids, storage, UserLocks(), io_executor, workers=2)
+
+    async def contact(*user_ids):
+        return await asyncio.gather(
+            *(renames.hashed_id(user_id) for user_id in user_ids)
+        )
+
+    try:
+        hashed_ids = asyncio.run(contact(1000, 1000, 3000))
+        assert hashed_ids == [user_ids.hashed(1000)] * 2 + [user_ids.hashed(3000)]
+        assert len(storage.read(user_ids.hashed(1000))) == 1
+        assert storage.read(legacy_hashed(1000)).empty
+        assert user_ids.legacy == {legacy_hashed(2000)}
+        assert not user_ids.needs_check(user_ids.hashed(1000))
+        assert not user_ids.needs_check(user_ids.hashed(3000))
+        # users already checked aren't looked up again after a restart
+        restarted = make_user_ids(tmp_path, [])
+        assert not restarted.needs_check(user_ids.hashed(3000))
+        assert restarted.needs_check(user_ids.hashed(2000))
+    finally:
+        renames.shutdown()
+        io_executor.shutdown()
+
+
+def test_users_the_index_knows_are_not_looked_up(tmp_path):
+    index = UserIndex(str(tmp_path / "users.sqlite"))
+    storage = IndexedStorage(CsvStorage(str(tmp_path)), index)
+    storage.append(legacy_hashed(1000), rows)
+    user_ids = make_user_ids(tmp_path, storage.hashed_ids())
+    storage.append(user_ids.hashed(2000), rows)
+    user_ids.legacy_id = lambda user_id: pytest.fail("looked up")
+    io_executor = IOExecutor(2)
+    renames = LegacyRenames(user_ids, storage, UserLocks(), io_executor, index)
+    try:
+        asyncio.run(renames.hashed_id(2000))
+        assert not user_ids.needs_check(user_ids.hashed(2000))
+    finally:
+        renames.shutdown()
+        io_executor.shutdown()
+        storage.close()
+
+
+def test_rename_while_the_index_is_built(tmp_path):
+    """A history renamed after the index build listed the users stays indexed under its new id."""
+    index = UserIndex(str(tmp_path / "users.sqlite"))
+    storage = IndexedStorage(CsvStorage(str(tmp_path)), index)
+    storage.append("aaaa1111", rows * 3)
+    index.deleted_all("aaaa1111")  # not counted yet
+    listed = list(storage.hashed_ids())
+
+    assert storage.rename("aaaa1111", "bbbb2222")
+    for hashed_id in listed:
+        index.count_rows(hashed_id, storage.iter_rows(hashed_id))
+    index.mark_built()
+
+    assert len(storage.read("bbbb2222")) == 3
+    assert index.get("bbbb2222").rows == 3
+    assert index.get("aaaa1111") is None
+    storage.close()
@@ -1,30 +1,24 @@
+import io
 import json
-import os
-from typing import Dict
+import threading
+from typing import Dict, List
 
+import matplotlib
 import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
 import mplcyberpunk
-import pandas as pd
 import requests
 from pandas import DataFrame
 from telegram.ext import CallbackContext
 
-plt.style.use("cyberpunk")
-
-
-def read_csv(outdir: str, csv_name, df_columns) -> pd.DataFrame:
-    try:
-        df = pd.read_csv(os.path.join(outdir, f"{csv_name}.csv"), names=df_columns)
-        df = df.astype({"timestamp": "datetime64[s]"})
-    except Exception:
-        df = pd.DataFrame(columns=df_columns)
-
-    return df
+from gymbot.executor import IOExecutor
+from gymbot.exercises import ExerciseRegistry
 
+# plots are rendered in worker threads and only ever saved to files
+matplotlib.use("Agg")
+plt.style.use("cyberpunk")
 
-def write_csv(df, outdir: str, csv_name):
-    df.to_csv(os.path.join(outdir, f"{csv_name}.csv"), header=True, index=False)
+plot_lock = threading.Lock()
 
 
 def read_config(outdir: str) -> Dict:
@@ -101,47 +95,63 @@ def run_request(
     return json.loads(response.content.decode("UTF-8"))
 
 
+def render_plots(all_exercises: DataFrame, registry: ExerciseRegistry) -> List[bytes]:
+    """Plot the history of every exercise with its plot metric, returns the PNG images.
+
+    pyplot keeps global state, so rendering is serialized by plot_lock.
+    """
+    images = []
+    with plot_lock:
+        plt.rcParams.update({"font.size": 22})
+        for c in all_exercises["exercise"].unique():
+            plot_value = registry.get(c).plot
+            resampled = all_exercises.drop("group", axis=1)
+            resampled = resampled[resampled.exercise == c].drop("exercise", axis=1)
+            # imported sets may have been appended after newer ones
+            resampled = resampled.sort_values("timestamp", kind="stable")
+            drawstyle = "default"
+            fig, ax = plt.subplots(figsize=(15, 15))
+            ax.plot(resampled.timestamp, resampled[plot_value], drawstyle=drawstyle)
+            ax.scatter(resampled.timestamp, resampled[plot_value])
+            ax.xaxis.set_major_locator(mdates.DayLocator(interval=7))
+            ax.xaxis.set_major_formatter(mdates.DateFormatter("%d.%m. %H:%M"))
+            plt.gcf().autofmt_xdate()
+            plt.ylabel(plot_value)
+            plt.xlabel("Date")
+            plt.title(c)
+
+            for i, point in resampled.iterrows():
+                if plot_value == "kg":
+                    annotation = f'{point["kg"]:g} kg ({point["reps"]} reps)'
+                else:
+                    annotation = f'{point["reps"]} reps'
+                ax.annotate(
+                    annotation,
+                    (point["timestamp"], point[plot_value]),
+                    xytext=(10, -5),
+                    textcoords="offset points",
+                )
+
+            mplcyberpunk.add_glow_effects()
+            image = io.BytesIO()
+            plt.savefig(image, format="png")
+            images.append(image.getvalue())
+
+            plt.cla()
+            plt.clf()
+            plt.close("all")
+
+    return images
+
+
 async def plot_exercises(
-    all_exercises: DataFrame, hashed_id: str, chat_id: int, context: CallbackContext
+    all_exercises: DataFrame,
+    chat_id: int,
+    context: CallbackContext,
+    executor: IOExecutor,
+    registry: ExerciseRegistry,
 ):
-    plt.rcParams.update({"font.size": 22})
-    for c in all_exercises["exercise"].unique():
-        if c in ["Pullup overhand", "Pullup underhand", "Pushup", "The Countdown", "Hanging Leg Raise"]:
-            plot_value = "reps"
-        else:
-            plot_value = "kg"
-        resampled = all_exercises.drop("group", axis=1)
-        resampled = resampled[resampled.exercise == c].drop("exercise", axis=1)
-        drawstyle = "default"
-        fig, ax = plt.subplots(figsize=(15, 15))
-        ax.plot(resampled.timestamp, resampled[plot_value], drawstyle=drawstyle)
-        ax.scatter(resampled.timestamp, resampled[plot_value])
-        ax.xaxis.set_major_locator(mdates.DayLocator(interval=7))
-        ax.xaxis.set_major_formatter(mdates.DateFormatter("%d.%m. %H:%M"))
-        plt.gcf().autofmt_xdate()
-        plt.ylabel(plot_value)
-        plt.xlabel("Date")
-        plt.title(c)
-
-        for i, point in resampled.iterrows():
-            if plot_value == "kg":
-                annotation = f'{point["kg"]} kg ({point["reps"]} reps)'
-            else:
-                annotation = f'{point["reps"]} reps'
-            ax.annotate(
-                annotation,
-                (point["timestamp"], point[plot_value]),
-                xytext=(10, -5),
-                textcoords="offset points"
-            )
-
-        mplcyberpunk.add_glow_effects()
-        plt.savefig(f"{hashed_id}_{c}.png")
-
-        await context.bot.send_photo(chat_id, f"{hashed_id}_{c}.png")
-
-        plt.cla()
-        plt.clf()
-        plt.close("all")
+    for image in await executor.run(render_plots, all_exercises, registry):
+        await context.bot.send_photo(chat_id, image)
 
     return all_exercises["exercise"].unique()
@@ -0,0 +1,240 @@
+import functools
+import hashlib
+import logging
+import os
+import threading
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Set
+
+from gymbot.executor import IOExecutor
+from gymbot.index import UserIndex
+from gymbot.locks import UserLocks
+from gymbot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# the checkpoints are built up to this user id in the background, larger ids build the rest
+legacy_max_user_id = 10**10
+
+
+class ZeroMd5:
+    """md5 hex digests of runs of zero bytes, as the legacy `hashlib.md5(bytes(user_id))` hashed ids.
+
+    bytes(user_id) is a buffer of user_id zero bytes, gigabytes for current Telegram ids. The zeros
+    are fed in chunks instead, continuing from the saved md5 state after the closest multiple of
+    `checkpoint_bytes`, so memory use is constant and each digest hashes at most `checkpoint_bytes`
+    once the checkpoints up to it exist. build() saves them ahead of time.
+    """
+
+    def __init__(self, checkpoint_bytes: int = 64 << 20, chunk_bytes: int = 1 << 20):
+        self.checkpoint_bytes = checkpoint_bytes
+        self.zeros = memoryview(bytes(chunk_bytes))
+        # md5 states after i * checkpoint_bytes zeros
+        self.checkpoints = [hashlib.md5()]
+        self.lock = threading.Lock()
+
+    def feed(self, md5, n: int) -> None:
+        while n > 0:
+            size = min(n, len(self.zeros))
+            md5.update(self.zeros[:size])
+            n -= size
+
+    def _extend(self) -> None:
+        md5 = self.checkpoints[-1].copy()
+        self.feed(md5, self.checkpoint_bytes)
+        self.checkpoints.append(md5)
+
+    def build(self, n: int) -> None:
+        """Save the checkpoints up to n zero bytes, one at a time so digests can be taken meanwhile.
+
+        Checkpoints are only ever appended, so the ones that exist are read without the lock and
+        digests below the checkpoints built so far never wait.
+        """
+        index = n // self.checkpoint_bytes
+        while len(self.checkpoints) <= index:
+            with self.lock:
+                if len(self.checkpoints) <= index:
+                    self._extend()
+
+    def hexdigest(self, n: int) -> str:
+        index = n // self.checkpoint_bytes
+        self.build(n)
+        md5 = self.checkpoints[index].copy()
+        self.feed(md5, n - index * self.checkpoint_bytes)
+        return md5.hexdigest()
+
+
+class UserIds:
+    """Pseudonymous hashed ids of Telegram user ids.
+
+    The hashed id is a 16 byte blake2b digest of the user id's signed 8 byte big-endian encoding,
+    keyed with `key` if one is set, and memoized per process. Histories stored under the legacy
+    md5 hashed ids are listed in the file at `legacy_path` until they were renamed, only while
+    any are left the legacy hashed id of a user has to be computed. The hashed ids of the users
+    already checked are appended to the file at `checked_path`, so each user is checked once.
+    After `legacy_until` the histories left are no longer looked for.
+    """
+
+    def __init__(
+        self,
+        legacy_path: str,
+        key: bytes = b"",
+        cache_size: int = 65536,
+        legacy_until: Optional[date] = None,
+        checked_path: Optional[str] = None,
+        zero_md5: Optional[ZeroMd5] = None,
+    ):
+        self.legacy_path = legacy_path
+        self.checked_path = checked_path or legacy_path + ".checked"
+        self.key = key
+        self.legacy_until = legacy_until
+        self.zero_md5 = zero_md5 or ZeroMd5()
+        self.lock = threading.Lock()
+        self.legacy: Set[str] = set()
+        self.checked: Set[str] = set()
+        self.hashed = functools.lru_cache(maxsize=cache_size)(self._hashed)
+        self.legacy_hashed = functools.lru_cache(maxsize=cache_size)(
+            self._legacy_hashed
+        )
+
+    def _hashed(self, user_id: int) -> str:
+        data = user_id.to_bytes(8, "big", signed=True)
+        return hashlib.blake2b(data, digest_size=16, key=self.key).hexdigest()
+
+    def _legacy_hashed(self, user_id: int) -> str:
+        return self.zero_md5.hexdigest(user_id)
+
+    @property
+    def legacy_left(self) -> bool:
+        if self.legacy_until is not None and date.today() > self.legacy_until:
+            return False
+        return bool(self.legacy)
+
+    def load_legacy(self, hashed_ids: Iterable[str]) -> None:
+        """Read the legacy hashed ids left; on the first start these are all stored hashed_ids."""
+        try:
+            with open(self.legacy_path) as file:
+                self.legacy = {line.strip() for line in file if line.strip()}
+        except FileNotFoundError:
+            self.legacy = set(hashed_ids)
+            self._save()
+        try:
+            with open(self.checked_path) as file:
+                self.checked = {line.strip() for line in file if line.endswith("\n")}
+        except FileNotFoundError:
+            self.checked = set()
+        if self.legacy:
+            logger.warning(f"{len(self.legacy)} histories still have legacy hashed ids")
+            if not self.legacy_left:
+                logger.warning(
+                    f"Legacy hashed ids are not looked for after {self.legacy_until}"
+                )
+
+    def build_checkpoints(self) -> None:
+        """Start building the md5 checkpoints of legacy_id() in a background thread, so first
+        contacts of users don't each hash gigabytes of zeros while legacy hashed ids are left.
+        """
+        if self.legacy_left:
+            threading.Thread(
+                target=self.zero_md5.build,
+                args=(legacy_max_user_id,),
+                name="gymbot-legacy-checkpoints",
+                daemon=True,
+            ).start()
+
+    def needs_check(self, hashed_id: str) -> bool:
+        """Whether the user may still have a history under their legacy hashed id."""
+        return self.legacy_left and hashed_id not in self.checked
+
+    def mark_checked(self, hashed_id: str) -> None:
+        with self.lock:
+            if hashed_id in self.checked:
+                return
+            self.checked.add(hashed_id)
+            with open(self.checked_path, "a") as file:
+                file.write(f"{hashed_id}\n")
+
+    def legacy_id(self, user_id: int) -> Optional[str]:
+        """The legacy hashed id of a user if their history still has it, None otherwise."""
+        if not self.legacy_left or user_id < 0:
+            return None
+        legacy_id = self.legacy_hashed(user_id)
+        return legacy_id if legacy_id in self.legacy else None
+
+    def renamed(self, legacy_id: str) -> None:
+        with self.lock:
+            self.legacy.discard(legacy_id)
+            self._save()
+        if not self.legacy:
+            logger.warning("All histories have been renamed to the new hashed ids")
+
+    def _save(self) -> None:
+        legacy: List[str] = sorted(self.legacy)
+        with open(self.legacy_path + ".tmp", "w") as file:
+            file.write("".join(f"{hashed_id}\n" for hashed_id in legacy))
+        os.replace(self.legacy_path + ".tmp", self.legacy_path)
+
+
+class LegacyRenames:
+    """Moves the history of a user stored under their legacy hashed id to the new one on first
+    contact.
+
+    Only users not checked before are looked up, and neither are users the user index already
+    knows under the new id. Legacy hashed ids are computed on `workers` threads of their own, which
+    may have to wait for md5 checkpoints, so the I/O threads and users already checked never do.
+    """
+
+    def __init__(
+        self,
+        user_ids: UserIds,
+        storage: Storage,
+        user_locks: UserLocks,
+        io_executor: IOExecutor,
+        user_index: Optional[UserIndex] = None,
+        workers: int = 4,
+    ):
+        self.user_ids = user_ids
+        self.storage = storage
+        self.user_locks = user_locks
+        self.io_executor = io_executor
+        self.user_index = user_index
+        self.executor = IOExecutor(workers, "gymbot-legacy-ids")
+
+    async def hashed_id(self, user_id: int) -> str:
+        """The hashed id of a user, renaming their history from its legacy hashed id if needed."""
+        hashed_id = self.user_ids.hashed(user_id)
+        if not self.user_ids.needs_check(hashed_id):
+            return hashed_id
+        async with self.user_locks.hold(hashed_id):
+            # another update of the user may have checked meanwhile
+            if self.user_ids.needs_check(hashed_id):
+                await self._check(user_id, hashed_id)
+        return hashed_id
+
+    async def _check(self, user_id: int, hashed_id: str) -> None:
+        if self.user_index is not None:
+            known = await self.io_executor.run(self.user_index.get, hashed_id)
+            if known is not None:
+                await self.io_executor.run(self.user_ids.mark_checked, hashed_id)
+                return
+        legacy_id = await self.executor.run(self.user_ids.legacy_id, user_id)
+        if legacy_id is not None:
+            async with self.user_locks.hold(legacy_id):
+                await self.io_executor.run(self.storage.rename, legacy_id, hashed_id)
+            await self.io_executor.run(self.user_ids.renamed, legacy_id)
+        await self.io_executor.run(self.user_ids.mark_checked, hashed_id)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown()
+
+
+def get_user_ids(config: Dict, outdir: str) -> UserIds:
+    """UserIds keyed with the optional `user_id_key` of env.json, looking for legacy hashed ids up to
+    the optional `legacy_ids_until` date."""
+    until = config.get("legacy_ids_until")
+    return UserIds(
+        os.path.join(outdir, "legacy_user_ids.txt"),
+        config.get("user_id_key", "").encode(),
+        legacy_until=date.fromisoformat(until) if until else None,
+        checked_path=os.path.join(outdir, "legacy_checked_ids.txt"),
+    )
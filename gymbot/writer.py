@@ -0,0 +1,140 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, TextIO
+
+logger = logging.getLogger(__name__)
+
+WRITE, FLUSH, RELEASE, CLOSE = range(4)
+
+
+class BufferedWriter:
+    """Group-commit writer for the per-user append-only files.
+
+    Handlers hand lines over through an in-memory queue and return immediately. A background
+    thread collects them and writes them in batches, once `batch_size` lines are pending or
+    `flush_interval` seconds after the first pending line, whichever comes first. Every file
+    written in a batch is flushed and, if `fsync` is set, fsynced once per batch. Open file
+    handles are kept in an LRU pool of at most `max_open_files`.
+
+    Durability: a line is on disk only after the batch holding it was written. A crash of the
+    process or of the machine loses at most the lines of the last `flush_interval` seconds (with
+    `fsync` disabled, a machine crash can additionally lose whatever the OS had not written back).
+    flush() waits until everything queued before it is written, and close() flushes everything
+    before returning, so a clean shutdown loses nothing.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = 1.0,
+        batch_size: int = 100,
+        max_open_files: int = 64,
+        fsync: bool = True,
+    ):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_open_files = max_open_files
+        self.fsync = fsync
+        self.queue = queue.Queue()
+        self.files: "OrderedDict[str, TextIO]" = OrderedDict()
+        self.pending: Dict[str, List[str]] = {}
+        self.pending_count = 0
+        self.thread = threading.Thread(
+            target=self._run, name="gymbot-writer", daemon=True
+        )
+        self.thread.start()
+
+    def write(self, path: str, data: str) -> None:
+        """Queue data to be appended to the file at path."""
+        self.queue.put((WRITE, path, data))
+
+    def flush(self) -> None:
+        """Block until everything queued so far is written."""
+        self._wait(FLUSH)
+
+    def release(self, path: str) -> None:
+        """Flush everything and close the handle of path, before the file is truncated or removed."""
+        self._wait(RELEASE, path)
+
+    def close(self) -> None:
+        """Flush everything, close all handles and stop the writer thread."""
+        if self.thread.is_alive():
+            self._wait(CLOSE)
+            self.thread.join()
+
+    def _wait(self, command: int, path: Optional[str] = None) -> None:
+        done = threading.Event()
+        self.queue.put((command, path, done))
+        done.wait()
+
+    def _run(self) -> None:
+        deadline = None
+        while True:
+            timeout = (
+                None if deadline is None else max(0.0, deadline - time.monotonic())
+            )
+            try:
+                command, path, payload = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                deadline = self._flush_pending()
+                continue
+
+            if command == WRITE:
+                self.pending.setdefault(path, []).append(payload)
+                self.pending_count += 1
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if self.pending_count >= self.batch_size:
+                    deadline = self._flush_pending()
+                continue
+
+            deadline = self._flush_pending()
+            if command == RELEASE:
+                self._close_file(path)
+            elif command == CLOSE:
+                for open_path in list(self.files):
+                    self._close_file(open_path)
+                payload.set()
+                return
+            payload.set()
+
+    def _open(self, path: str) -> TextIO:
+        file = self.files.get(path)
+        if file is None:
+            file = open(path, "a")
+            self.files[path] = file
+            if len(self.files) > self.max_open_files:
+                self._close_file(next(iter(self.files)))
+        else:
+            self.files.move_to_end(path)
+        return file
+
+    def _close_file(self, path: str) -> None:
+        file = self.files.pop(path, None)
+        if file is not None:
+            try:
+                file.close()
+            except OSError as e:
+                logger.error(f"Closing {path} failed: {e}")
+
+    def _flush_pending(self) -> Optional[float]:
+        """Write all pending lines, returns the deadline for retrying the ones that failed."""
+        for path in list(self.pending):
+            lines = self.pending[path]
+            try:
+                file = self._open(path)
+                file.write("".join(lines))
+                file.flush()
+                if self.fsync:
+                    os.fsync(file.fileno())
+            except OSError as e:
+                # keep the lines and retry with the next batch
+                logger.error(f"Writing {len(lines)} lines to {path} failed: {e}")
+                self._close_file(path)
+                continue
+            del self.pending[path]
+            self.pending_count -= len(lines)
+        return time.monotonic() + self.flush_interval if self.pending else None